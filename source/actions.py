@@ -8,10 +8,7 @@ import os.path
 import subprocess
 
 import workflow
-import ccl_bplist
-
-HOME = os.path.expanduser("~")
-BIB_DIR = HOME + "/Library/Caches/Metadata/edu.ucsd.cs.mmccrack.bibdesk/"
+from library import find_record
 
 ################################################
 # AppleScript Functions
@@ -56,21 +53,6 @@ def set_clipboard(data):
     """.format(_applescriptify_str(data))
     subprocess.call(['osascript', '-e', scpt])
 
-################################################
-# Helper Function
-################################################
-
-def read_cachedir():
-    """Read BibDesk cache dir into Python array"""
-    _data = []
-    for bib in os.listdir(BIB_DIR):
-        bib_path = os.path.join(BIB_DIR, bib)
-        with open(bib_path, 'rb') as _file:
-            bib_data = ccl_bplist.load(_file)
-            _file.close()
-        _data.append(bib_data)
-    return _data
-
 ################################################
 # Actions
 ################################################   
@@ -81,12 +63,12 @@ def export_cite_command(cite_key):
     set_clipboard(cmd)
     return "Cite Command"
 
-def open_attachment(cite_key):
+def open_attachment(cite_key, wf):
     """Open PDF attachment in default app"""
-    data = read_cachedir()
-    sources = [x['kMDItemWhereFroms']
-                for x in data
-                if x['net_sourceforge_bibdesk_citekey'] == cite_key]
+    item = find_record(wf, cite_key, keys=['kMDItemWhereFroms'])
+    sources = []
+    if item is not None:
+        sources.append(item.get('kMDItemWhereFroms', []))
     for _val in sources:
         if _val != []:
             for source in _val:
@@ -140,7 +122,7 @@ def act(cite_key, action, wf):
     elif action == 'cite':
         return export_cite_command(cite_key)
     elif action == 'att':
-        open_attachment(cite_key)
+        open_attachment(cite_key, wf)
     elif action == 'save_group':
         save_group(cite_key, wf)
     elif action == 'save_keyword':
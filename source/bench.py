@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""Micro-benchmarks for the BibQuery hot paths.
+
+Run with ``python bench.py`` (or e.g. ``python bench.py ints`` to run a
+single group). All data is synthetic, so no BibDesk library is needed.
+"""
+from __future__ import print_function, unicode_literals
+
+import sys
+import random
+import struct
+import timeit
+
+import ccl_bplist
+from workflow.workflow import search_key, char_mask
+
+try:
+    unicode
+except NameError:  # Python 3
+    unicode = str
+
+
+################################################
+# Synthetic binary plists
+################################################
+
+def _int_size(value):
+    """Smallest of 1, 2, 4, 8 bytes that holds unsigned `value`"""
+    for size in (1, 2, 4):
+        if value < 1 << (8 * size):
+            return size
+    return 8
+
+
+def _pack_uint(value, size):
+    return struct.pack(str({1: '>B', 2: '>H', 4: '>I', 8: '>Q'}[size]), value)
+
+
+def _marker(kind, count):
+    if count < 15:
+        return struct.pack(str('>B'), kind | count)
+    size = _int_size(count)
+    return (struct.pack(str('>BB'), kind | 0x0F, 0x10 | (size.bit_length() - 1)) +
+            _pack_uint(count, size))
+
+
+def write_bplist(obj, offset_size=None):
+    """Serialise `obj` (dicts, lists, unicode, bytes, ints, floats, bools and
+    None) as a binary plist. Strings are shared between references and
+    containers are flattened breadth-first, so arbitrarily deep structures
+    can be written. `offset_size` forces the width of offset table entries.
+    """
+    objects = [obj]
+    refs = []
+    strings = {}
+    i = 0
+    while i < len(objects):
+        o = objects[i]
+        if isinstance(o, dict):
+            children = list(o.keys()) + list(o.values())
+        elif isinstance(o, list):
+            children = o
+        else:
+            children = []
+        child_refs = []
+        for child in children:
+            if isinstance(child, unicode) and child in strings:
+                child_refs.append(strings[child])
+                continue
+            if isinstance(child, unicode):
+                strings[child] = len(objects)
+            child_refs.append(len(objects))
+            objects.append(child)
+        refs.append(child_refs)
+        i += 1
+
+    ref_size = _int_size(len(objects))
+    bodies = []
+    for o, child_refs in zip(objects, refs):
+        if o is None:
+            body = b'\x00'
+        elif o is False:
+            body = b'\x08'
+        elif o is True:
+            body = b'\x09'
+        elif isinstance(o, int):
+            body = struct.pack(str('>Bq'), 0x13, o)
+        elif isinstance(o, float):
+            body = struct.pack(str('>Bd'), 0x23, o)
+        elif isinstance(o, unicode):
+            try:
+                body = _marker(0x50, len(o)) + o.encode('ascii')
+            except UnicodeEncodeError:
+                body = _marker(0x60, len(o)) + o.encode('utf_16_be')
+        elif isinstance(o, bytes):
+            body = _marker(0x40, len(o)) + o
+        elif isinstance(o, dict):
+            body = _marker(0xD0, len(o)) + b''.join(
+                _pack_uint(r, ref_size) for r in child_refs)
+        elif isinstance(o, list):
+            body = _marker(0xA0, len(o)) + b''.join(
+                _pack_uint(r, ref_size) for r in child_refs)
+        else:
+            raise TypeError('Cannot write {0!r}'.format(o))
+        bodies.append(body)
+
+    offsets = []
+    position = 8
+    for body in bodies:
+        offsets.append(position)
+        position += len(body)
+    offset_size = offset_size or _int_size(position)
+    trailer = struct.pack(str('>6xBBQQQ'), offset_size, ref_size,
+                          len(objects), 0, position)
+    return (b'bplist00' + b''.join(bodies) +
+            b''.join(_pack_uint(o, offset_size) for o in offsets) + trailer)
+
+
+def bibdesk_record(i):
+    """A dict shaped like a BibDesk `.bdskcache` file"""
+    return {
+        'net_sourceforge_bibdesk_citekey': 'Smith_{0}_Record'.format(i),
+        'net_sourceforge_bibdesk_pubtype': 'article',
+        'net_sourceforge_bibdesk_container': 'Journal of Roman Studies',
+        'net_sourceforge_bibdesk_owningfilepath': '/Users/me/main.bib',
+        'net_sourceforge_bibdesk_itemreadstatus': bool(i % 2),
+        'kMDItemTitle': 'On the Friendship of Lucretius, part {0}'.format(i),
+        'kMDItemDisplayName': 'On the Friendship of Lucretius',
+        'kMDItemAuthors': ['Smith, John', 'Müller, Anna', 'Jones, B.'],
+        'kMDItemKeywords': ['latin', 'poetry', 'epicureanism'],
+        'kMDItemWhereFroms': [],
+        'kMDItemDescription': ' '.join(['abstract words'] * 150),
+        'kMDItemCreator': 'BibDesk',
+    }
+
+
+def nested_lists(depth):
+    """A list nested `depth` levels deep"""
+    obj = ['leaf']
+    for i in range(depth):
+        obj = [i, obj]
+    return obj
+
+
+################################################
+# Benchmarks
+################################################
+
+def _best(func, number, repeat=5):
+    """Best time per call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench_decoder():
+    """Recursive vs iterative `ccl_bplist` decoder"""
+    cases = [
+        ('flat BibDesk record', write_bplist(bibdesk_record(1)), 2000),
+        ('nested lists, depth 100', write_bplist(nested_lists(100)), 500),
+        ('nested lists, depth 5000', write_bplist(nested_lists(5000)), 10),
+    ]
+    print('{0:<28} {1:>14} {2:>14}'.format('decoder', 'recursive us',
+                                          'iterative us'))
+    for name, data, number in cases:
+        iterative = _best(lambda: ccl_bplist.loads(data, iterative=True),
+                          number)
+        try:
+            assert (ccl_bplist.loads(data, iterative=False) ==
+                    ccl_bplist.loads(data, iterative=True))
+            recursive = '{0:14.1f}'.format(_best(
+                lambda: ccl_bplist.loads(data, iterative=False), number))
+        except RuntimeError:  # maximum recursion depth exceeded
+            recursive = '{0:>14}'.format('RecursionError')
+        print('{0:<28} {1} {2:14.1f}'.format(name, recursive, iterative))
+
+
+def _unpack_one_by_one(buf, offset, count, size):
+    """Offset table decoding as `ccl_bplist.load` originally did it"""
+    fmt = {1: '>B', 2: '>H', 4: '>I', 8: '>Q'}[size]
+    return [struct.unpack(str(fmt), buf[offset + i * size:
+                                         offset + (i + 1) * size])[0]
+            for i in range(count)]
+
+
+def bench_int_tables():
+    """Offset table / object ref decoding, 5,000 entries per table"""
+    count = 5000
+    decode_refs = getattr(ccl_bplist, '__decode_refs')
+    print('{0:<10} {1:>16} {2:>12} {3:>9}'.format('width', 'per-entry us',
+                                                  'bulk us', 'speedup'))
+    for size in (1, 2, 3, 4, 8):
+        values = [(i * 7919) % (1 << (8 * size)) for i in range(count)]
+        buf = b''.join(_pack_uint(v, size if size != 3 else 4)[-size:]
+                       for v in values)
+        assert list(decode_refs(buf, 0, count, size)) == values
+        bulk = _best(lambda: decode_refs(buf, 0, count, size), 200)
+        if size == 3:
+            per_entry = _best(lambda: [
+                getattr(ccl_bplist, '__decode_multibyte_int')(
+                    buf[i:i + 3], False)
+                for i in range(0, count * 3, 3)], 20)
+        else:
+            per_entry = _best(
+                lambda: _unpack_one_by_one(buf, 0, count, size), 20)
+        print('{0:<10} {1:16.1f} {2:12.1f} {3:8.1f}x'.format(
+            '{0} byte'.format(size), per_entry, bulk, per_entry / bulk))
+
+
+def search_values(count, seed=1):
+    """`count` search keys shaped like a `general` scope `stringify`"""
+    rand = random.Random(seed)
+    words = ['friendship', 'lucretius', 'epicurean', 'poetry', 'roman',
+             'republic', 'atoms', 'nature', 'philosophy', 'reception',
+             'cicero', 'virgil', 'didactic', 'Müller', 'Smith', 'Jones',
+             'Journal of Roman Studies', 'Classical Quarterly', 'Phoenix']
+    return [' '.join(rand.choice(words) for _ in range(rand.randint(5, 12))) +
+            ' {0}'.format(rand.randint(1900, 2015)) for _ in range(count)]
+
+
+def _prefilter_sets(query, lowers):
+    queryset = set(query)
+    return [i for i, lower in enumerate(lowers) if queryset <= set(lower)]
+
+
+def _prefilter_masks(query, keys):
+    query_mask = char_mask(query)[0]
+    return [i for i, key in enumerate(keys)
+            if key[5] & query_mask == query_mask]
+
+
+def bench_char_masks():
+    """Character-set vs bitmask pre-filter, 50,000 search keys"""
+    keys = [search_key(value) for value in search_values(50000)]
+    lowers = [key[1] for key in keys]
+    print('{0:<10} {1:>9} {2:>10} {3:>10} {4:>9}'.format(
+        'query', 'rejected', 'sets ms', 'masks ms', 'speedup'))
+    for query in ('luc', 'zeta', 'qx', 'smith 19', 'epicurean', 'vw'):
+        kept = _prefilter_masks(query, keys)
+        assert kept == _prefilter_sets(query, lowers)
+        sets = _best(lambda: _prefilter_sets(query, lowers), 1, 3) / 1000
+        masks = _best(lambda: _prefilter_masks(query, keys), 1, 3) / 1000
+        print('{0:<10} {1:8.1f}% {2:10.1f} {3:10.1f} {4:8.1f}x'.format(
+            query, 100.0 - 100.0 * len(kept) / len(keys), sets, masks,
+            sets / masks))
+
+
+BENCHMARKS = [
+    ('decoder', bench_decoder),
+    ('ints', bench_int_tables),
+    ('masks', bench_char_masks),
+]
+
+
+def main(args):
+    for name, func in BENCHMARKS:
+        if args and name not in args:
+            continue
+        print('## {0}: {1}'.format(name, func.__doc__))
+        func()
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,15 +5,16 @@ from __future__ import unicode_literals
 import re
 import sys
 import urllib
-import plistlib
 import os.path
 import subprocess
 
 import workflow
-import ccl_bplist
+from library import (load_library, load_bibs, load_groups, bitset_ids,
+                     CITEKEY)
+from search import filter_ids
 
-HOME = os.path.expanduser("~")
-BIB_DIR = HOME + "/Library/Caches/Metadata/edu.ucsd.cs.mmccrack.bibdesk/"
+# Most results to show in Alfred
+MAX_RESULTS = 50
 
 def querify(query):
     """Return `query` as list"""
@@ -24,117 +25,27 @@ def querify(query):
     return queries
 
 ################################################
-# Convert `dict` to string
+# Read BibDesk library
 ################################################
 
-def _get_datum(_dict, key):
-    """Get value from key"""
-    try:
-        if _dict[key] != []:
-            if key == 'kMDItemAuthors':
-                names = [x.split(', ') for x in _dict[key]]
-                _res = [n[0] for n in names]
-            elif key == 'net_sourceforge_bibdesk_publicationdate':
-                year = str(_dict[key]).split('-')[0]
-                _res = [year]
-            else:
-                if isinstance(_dict[key], str):
-                    _res = [_dict[key]]
-                elif isinstance(_dict[key], unicode):
-                    _res = [_dict[key]]
-                elif isinstance(_dict[key], list):
-                    _res = _dict[key]
-        else:
-            _res = []
-    except KeyError:
-        _res = []
-    return _res
-
-def stringify(_dict, scope='general'):
-    """Convert `dict` to string, depending on `scope`"""
-    _list = []
-    if scope == 'general':
-        _list += _get_datum(_dict, 'kMDItemTitle')
-        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_container')
-        _list += _get_datum(_dict, 'kMDItemAuthors')
-        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
-    elif scope == 'titles':
-        _list += _get_datum(_dict, 'kMDItemTitle')
-        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_container')
-        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
-    elif scope == 'creators':
-        _list += _get_datum(_dict, 'kMDItemAuthors')
-        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
-    _list = [unicode(x) for x in _list]
-    _str = ' '.join(_list)
-    return _str 
-
-
-################################################
-# Read BibDesk `bplist` files
-################################################
-
-def read_cachedir():
-    """Read BibDesk cache dir into Python array"""
-    _data = []
-    for bib in os.listdir(BIB_DIR):
-        bib_path = os.path.join(BIB_DIR, bib)
-        with open(bib_path, 'rb') as _file:
-            #print _file.read(8) == b"bplist00"
-            bib_data = ccl_bplist.load(_file)
-            _file.close()
-        _data.append(bib_data)
-    return _data
-
-def read_cachefile(_bib):
-    """Read BibDesk cache file into Python dict"""
-    bib_path = os.path.join(BIB_DIR, _bib)
-    with open(bib_path, 'rb') as _file:
-        bib_data = ccl_bplist.load(_file)
-        _file.close()
-    return bib_data
-
-def get_bibfiles():
-    """Get all referenced `.bib` files"""
-    data = read_cachedir()
-    bibs = []
-    for item in data:
-        if not item['net_sourceforge_bibdesk_owningfilepath'] in bibs:
-            bibs.append(item['net_sourceforge_bibdesk_owningfilepath'])
-    return bibs
+def get_bibfiles(wf, lib=None):
+    """Get all referenced `.bib` files, from `lib` if it is loaded, else
+    without loading the library's records"""
+    bibs = lib.bibs if lib is not None else load_bibs(wf)
+    if bibs is None:
+        bibs = load_library(wf).bibs
+    return sorted(bibs)
 
-def get_groups(group):
+def get_groups(group, wf, lib=None):
     """Helper function to get BibDesk Groups"""
-    regex = r"@comment{BibDesk %s Groups{(.*?)}}" % group
-    bibs = get_bibfiles()
-    data = []
-    for _bib in bibs:
-        with open(_bib, 'rb') as _file:
-            _data = _file.read()
-            _file.close()
-        try:
-            plist = re.search(regex, _data, re.S).group(1)
-            data += plistlib.readPlistFromString(plist.strip())
-        except AttributeError:
-            pass
-    return data
-
-def get_group_items(group_name):
-    """Get all items for Static Group"""
-    groups = get_groups('Static')
-    data = read_cachedir()
-
-    _items = []
-    for group in groups:
-        if group['group name'] == group_name:
-            items = group['keys']
-            _items = items.split(',')
-
-    group_items = []
-    for item in data:
-        if item['net_sourceforge_bibdesk_citekey'] in _items:
-            group_items.append(item)
-    return group_items
+    return load_groups(wf, group, get_bibfiles(wf, lib))
+
+def get_group_ids(group_name, lib):
+    """Get sorted record ids of Static or Smart Group"""
+    # Static groups win over Smart groups of the same name
+    groups = lib.group_bits(get_groups('Smart', lib.wf, lib) +
+                            get_groups('Static', lib.wf, lib))
+    return bitset_ids(groups.get(group_name, 0))
 
 def get_group_name(wf):
     """Get name of Group from tmp file"""
@@ -143,17 +54,6 @@ def get_group_name(wf):
         _file.close()
     return group
 
-def get_keyword_items(keyword_name):
-    """Get all items for Keyword"""
-    data = read_cachedir()
-
-    keyword_items = []
-    for item in data:
-        for keyword in item['kMDItemKeywords']:
-            if keyword == keyword_name:
-                keyword_items.append(item)
-    return keyword_items
-
 def get_keyword_name(wf):
     """Get name of Keyword from tmp file"""
     with open(wf.cachefile("keyword_result.txt"), 'r') as _file:
@@ -233,15 +133,15 @@ def info_format(_item):
 def prepare_attachments(_item):
     """Get path to pdf attachments"""
     attachments = []
-    for _key, _val in _item.items():
-        if _key == 'kMDItemWhereFroms' and _val != []:
-            for source in _val:
-                if 'pdf' in source:
-                    if not 'http' in source:
-                        clean_file = urllib.unquote(source)
-                        _file = clean_file.replace('file://localhost', '')
-                        if os.path.isfile(_file):
-                            attachments.append(_file)
+    _val = _item.get('kMDItemWhereFroms', [])
+    if _val != []:
+        for source in _val:
+            if 'pdf' in source:
+                if not 'http' in source:
+                    clean_file = urllib.unquote(source)
+                    _file = clean_file.replace('file://localhost', '')
+                    if os.path.isfile(_file):
+                        attachments.append(_file)
     return attachments
 
 def prepare_feedback(data):
@@ -305,12 +205,31 @@ def prepare_feedback(data):
 # Filters
 ################################################
 
+def filter_records(queries, ids, scope, lib, wf, context=None):
+    """Return the best `MAX_RESULTS` records of `ids` for `queries` (see
+    `filter_ids`), one per citekey.
+
+    The same entry may be in several open `.bib` files, and only its
+    best match is shown, so more results are fetched until there are
+    `MAX_RESULTS` distinct citekeys or no more matches"""
+    limit = MAX_RESULTS
+    while True:
+        data = filter_ids(queries, ids, scope, lib, wf, context, limit)
+        seen = set()
+        distinct = []
+        for item in data:
+            if item.get(CITEKEY) not in seen:
+                seen.add(item.get(CITEKEY))
+                distinct.append(item)
+        if len(distinct) >= MAX_RESULTS or len(data) < limit:
+            return distinct[:MAX_RESULTS]
+        limit *= 2
+
 def simple_filter(query, scope, wf):
     """Search through BibDesk items"""
     queries = querify(query)
-    data = read_cachedir()
-    for query in queries:
-        data = wf.filter(query, data, key=lambda x: stringify(x, scope))
+    lib = load_library(wf)
+    data = filter_records(queries, range(len(lib.records)), scope, lib, wf)
     if data != []:
         prep_res = prepare_feedback(data)  
         for item in prep_res:
@@ -322,8 +241,8 @@ def simple_filter(query, scope, wf):
 def group_filter(query, wf):
     """Search through BibDesk Groups"""
     queries = querify(query)
-    statics = get_groups('Static')
-    smarts = get_groups('Smart')
+    statics = get_groups('Static', wf)
+    smarts = get_groups('Smart', wf)
     
     for query in queries:
         st_groups = [x['group name'] 
@@ -355,12 +274,10 @@ def group_filter(query, wf):
 
 def keyword_filter(query, wf):
     """Search through items' Keywords"""
-    _data = read_cachedir()
+    counts = load_library(wf).keyword_counts()
     queries = querify(query)
-    keywords = [x['kMDItemKeywords']
-            for x in _data
-            if x['kMDItemKeywords'] != []]
-    keywords = [item for sublist in keywords for item in sublist]
+    # Most used first
+    keywords = sorted(counts, key=lambda k: (-counts[k], k.lower()))
     
     for query in queries:
         keywords = [k
@@ -369,7 +286,7 @@ def keyword_filter(query, wf):
     xml = []
     for tag in keywords:
         _dict = {'title': tag, 
-                'subtitle': "BibDesk Keyword", 
+                'subtitle': "BibDesk Keyword ({0} items)".format(counts[tag]), 
                 'valid': True, 
                 'arg': tag,
                 'icon': 'icons/n_tag.png'}
@@ -383,10 +300,9 @@ def in_group_filter(query, wf):
     """Search within chosen group"""
     queries = querify(query)
     group_name = get_group_name(wf)
-    group_items = get_group_items(group_name)
-
-    for query in queries:
-        group_items = wf.filter(query, group_items, key=lambda x: stringify(x))
+    lib = load_library(wf)
+    group_items = filter_records(queries, get_group_ids(group_name, lib),
+                                 'general', lib, wf, ('group', group_name))
     
     if group_items != []:
         prep_res = prepare_feedback(group_items)  
@@ -400,10 +316,10 @@ def in_keyword_filter(query, wf):
     """Search within chosen group"""
     queries = querify(query)
     keyword_name = get_keyword_name(wf)
-    keyword_items = get_keyword_items(keyword_name)
-
-    for query in queries:
-        keyword_items = wf.filter(query, keyword_items, key=lambda x: stringify(x))
+    lib = load_library(wf)
+    keyword_items = filter_records(queries, lib.keyword_ids(keyword_name),
+                                   'general', lib, wf,
+                                   ('keyword', keyword_name))
     
     if keyword_items != []:
         prep_res = prepare_feedback(keyword_items)  
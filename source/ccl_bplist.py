@@ -25,8 +25,10 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import io
 import sys
-import os
+import mmap
+import array
 import struct
 import datetime
 
@@ -59,50 +61,106 @@ class BplistUID:
     def __str__(self):
         return self.__repr__()
 
+__int_structs = {
+    (1, True): struct.Struct(">B"), # Always unsigned?
+    (1, False): struct.Struct(">B"),
+    (2, True): struct.Struct(">h"),
+    (2, False): struct.Struct(">H"),
+    (4, True): struct.Struct(">i"),
+    (4, False): struct.Struct(">I"),
+    (8, True): struct.Struct(">q"),
+    (8, False): struct.Struct(">Q"),
+}
+
 def __decode_multibyte_int(b, signed=True):
-    if len(b) == 1:
-        fmt = ">B" # Always unsigned?
-    elif len(b) == 2:
-        fmt = ">h"
+    int_struct = __int_structs.get((len(b), signed))
+    if int_struct is not None:
+        return int_struct.unpack(b)[0]
     elif len(b) == 3:
+        b = bytearray(b)
+        value = (b[0] << 16) | (b[1] << 8) | b[2]
         if signed:
-            return ((b[0] << 16) | struct.unpack(">H", b[1:])[0]) - ((b[0] >> 7) * 2 * 0x800000)
-        else:
-            return (b[0] << 16) | struct.unpack(">H", b[1:])[0]
-    elif len(b) == 4:
-        fmt = ">i"
-    elif len(b) == 8:
-        fmt = ">q"
+            value -= (b[0] >> 7) * 2 * 0x800000
+        return value
     else:
         raise BplistError("Cannot decode multibyte int of length {0}".format(len(b)))
-    
-    if signed and len(b) > 1:
-        return struct.unpack(fmt.lower(), b)[0]
-    else:
-        return struct.unpack(fmt.upper(), b)[0]
+
+__float_structs = {4: struct.Struct(">f"), 8: struct.Struct(">d")}
 
 def __decode_float(b, signed=True):
-    if len(b) == 4:
-        fmt = ">f"
-    elif len(b) == 8:
-        fmt = ">d"
-    else:
+    if len(b) not in __float_structs:
         raise BplistError("Cannot decode float of length {0}".format(len(b)))
-
-    if signed: 
-        return struct.unpack(fmt.lower(), b)[0]
+    return __float_structs[len(b)].unpack(b)[0]
+
+def __find_uint_typecodes():
+    # Maps int width in bytes -> array typecode of an unsigned int with that itemsize
+    typecodes = {}
+    for typecode in "BHILQ":
+        try:
+            typecodes.setdefault(array.array(typecode).itemsize, typecode)
+        except ValueError: # "Q" is only available from Python 3.3
+            pass
+    return typecodes
+
+__uint_typecodes = __find_uint_typecodes()
+__swap_bytes = sys.byteorder == "little"
+
+__type_byte_struct = struct.Struct(">B")
+__not_decoded = object()
+
+def __read_type_byte(buf, offset):
+    return __type_byte_struct.unpack_from(buf, offset)[0]
+
+def __decode_length(buf, offset, type_byte, kind):
+    """Returns (length, offset of the object's data) for the variable length object at offset"""
+    if type_byte & 0x0F != 0x0F:
+        # length in 4 lsb
+        return type_byte & 0x0F, offset + 1
+    int_type_byte = __read_type_byte(buf, offset + 1)
+    if int_type_byte & 0xF0 != 0x10:
+        raise BplistError("Long {0} field definition not followed by int type at offset {1}".format(kind, offset + 2))
+    int_length = 2 ** (int_type_byte & 0x0F)
+    int_bytes = buf[offset + 2:offset + 2 + int_length]
+    return __decode_multibyte_int(int_bytes, False), offset + 2 + int_length
+
+def __decode_refs(buf, offset, count, int_size):
+    # Decodes a run of count big-endian unsigned ints (offset table entries or
+    # collection object refs) in one go rather than one struct.unpack per entry
+    end = offset + count * int_size
+    typecode = __uint_typecodes.get(int_size)
+    if typecode is not None:
+        refs = array.array(typecode, buf[offset:end])
+        if __swap_bytes and int_size > 1:
+            refs.byteswap()
+        return refs
+    elif int_size == 3:
+        # Widen to 4-byte big-endian ints by interleaving a zero high byte
+        b = bytearray(buf[offset:end])
+        padded = bytearray(count * 4)
+        padded[1::4] = b[0::3]
+        padded[2::4] = b[1::3]
+        padded[3::4] = b[2::3]
+        refs = array.array(__uint_typecodes[4], bytes(padded))
+        if __swap_bytes:
+            refs.byteswap()
+        return refs
     else:
-        return struct.unpack(fmt.upper(), b)[0]
-
-def __decode_object(f, offset, collection_offset_size, offset_table):
-    # Move to offset and read type
+        # Unusual widths: decode entry by entry (raises for unsupported ones)
+        return [__decode_multibyte_int(buf[i:i + int_size], False) for i in range(offset, end, int_size)]
+
+def __decode_ref(buf, obj_ref, collection_offset_size, offset_table, object_cache):
+    # Each object in the offset table is decoded at most once per load; objects the
+    # writer shared between several references are returned as the same instance
+    obj = object_cache[obj_ref]
+    if obj is __not_decoded:
+        obj = object_cache[obj_ref] = __decode_object(buf, offset_table[obj_ref], collection_offset_size, offset_table, object_cache)
+    return obj
+
+def __decode_object(buf, offset, collection_offset_size, offset_table, object_cache, type_byte=None):
+    # Decode the object at offset straight from the buffer
     #print("Decoding object at offset {0}".format(offset))
-    f.seek(offset)
-    # A little hack to keep the script portable between py2.x and py3k
-    if sys.version_info[0] < 3:
-        type_byte = ord(f.read(1)[0])
-    else:
-        type_byte = f.read(1)[0]
+    if type_byte is None:
+        type_byte = __read_type_byte(buf, offset)
     #print("Type byte: {0}".format(hex(type_byte)))
     if type_byte == 0x00: # Null      0000 0000
         return None
@@ -111,164 +169,187 @@ def __decode_object(f, offset, collection_offset_size, offset_table):
     elif type_byte == 0x09: # True    0000 1001
         return True
     elif type_byte == 0x0F: # Fill    0000 1111
-        raise BplistError("Fill type not currently supported at offset {0}".format(f.tell())) # Not sure what to return really...
+        raise BplistError("Fill type not currently supported at offset {0}".format(offset + 1)) # Not sure what to return really...
     elif type_byte & 0xF0 == 0x10: # Int    0001 xxxx
         int_length = 2 ** (type_byte & 0x0F)
-        int_bytes = f.read(int_length)
+        int_bytes = buf[offset + 1:offset + 1 + int_length]
         return __decode_multibyte_int(int_bytes)
     elif type_byte & 0xF0 == 0x20: # Float   0010 nnnn
         float_length = 2 ** (type_byte & 0x0F)
-        float_bytes = f.read(float_length)
+        float_bytes = buf[offset + 1:offset + 1 + float_length]
         return __decode_float(float_bytes)
     elif type_byte & 0xFF == 0x33: # Date   0011 0011
-        date_bytes = f.read(8)
+        date_bytes = buf[offset + 1:offset + 9]
         date_value = __decode_float(date_bytes)
         return datetime.datetime(2001,1,1) + datetime.timedelta(seconds = date_value)
     elif type_byte & 0xF0 == 0x40: # Data   0100 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            data_length = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Data field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            data_length = __decode_multibyte_int(int_bytes, False)
-        return f.read(data_length)
+        data_length, data_offset = __decode_length(buf, offset, type_byte, "Data")
+        return bytes(buf[data_offset:data_offset + data_length])
     elif type_byte & 0xF0 == 0x50: # ASCII  0101 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            ascii_length = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long ASCII field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            ascii_length = __decode_multibyte_int(int_bytes, False)
-        return f.read(ascii_length).decode("ascii")
+        ascii_length, ascii_offset = __decode_length(buf, offset, type_byte, "ASCII")
+        return buf[ascii_offset:ascii_offset + ascii_length].decode("ascii")
     elif type_byte & 0xF0 == 0x60: # UTF-16  0110 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            utf16_length = (type_byte & 0x0F) * 2 # Length is characters - 16bit width
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long UTF-16 field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            utf16_length = __decode_multibyte_int(int_bytes, False) * 2
-        return f.read(utf16_length).decode("utf_16_be")
+        utf16_length, utf16_offset = __decode_length(buf, offset, type_byte, "UTF-16")
+        utf16_length *= 2 # Length is characters - 16bit width
+        return buf[utf16_offset:utf16_offset + utf16_length].decode("utf_16_be")
     elif type_byte & 0xF0 == 0x80: # UID    1000 nnnn
         uid_length = (type_byte & 0x0F) + 1
-        uid_bytes = f.read(uid_length)
+        uid_bytes = buf[offset + 1:offset + 1 + uid_length]
         return BplistUID(__decode_multibyte_int(uid_bytes, signed=False))
     elif type_byte & 0xF0 == 0xA0: # Array  1010 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            array_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Array field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            array_count = __decode_multibyte_int(int_bytes, signed=False)
-        array_refs = []
-        for i in range(array_count):
-            array_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        return [__decode_object(f, offset_table[obj_ref], collection_offset_size, offset_table) for obj_ref in array_refs]
+        array_count, refs_offset = __decode_length(buf, offset, type_byte, "Array")
+        array_refs = __decode_refs(buf, refs_offset, array_count, collection_offset_size)
+        return [__decode_ref(buf, obj_ref, collection_offset_size, offset_table, object_cache) for obj_ref in array_refs]
     elif type_byte & 0xF0 == 0xC0: # Set  1010 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            set_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Set field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            set_count = __decode_multibyte_int(int_bytes, signed=False)
-        set_refs = []
-        for i in range(set_count):
-            set_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        return [__decode_object(f, offset_table[obj_ref], collection_offset_size, offset_table) for obj_ref in set_refs]
+        set_count, refs_offset = __decode_length(buf, offset, type_byte, "Set")
+        set_refs = __decode_refs(buf, refs_offset, set_count, collection_offset_size)
+        return [__decode_ref(buf, obj_ref, collection_offset_size, offset_table, object_cache) for obj_ref in set_refs]
     elif type_byte & 0xF0 == 0xD0: # Dict  1011 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            dict_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
+        return __decode_dict(buf, offset, type_byte, collection_offset_size, offset_table, object_cache)
+
+def __decode_dict(buf, offset, type_byte, collection_offset_size, offset_table, object_cache, wanted_keys=None):
+    # If wanted_keys is given, values are only decoded (and included) for those keys
+    dict_count, refs_offset = __decode_length(buf, offset, type_byte, "Dict")
+    #print("Dictionary count: {0}".format(dict_count))
+    key_refs = __decode_refs(buf, refs_offset, dict_count, collection_offset_size)
+    value_refs = __decode_refs(buf, refs_offset + dict_count * collection_offset_size, dict_count, collection_offset_size)
+
+    dict_result = {}
+    for i in range(dict_count):
+        #print("Key ref: {0}\tVal ref: {1}".format(key_refs[i], value_refs[i]))
+        key = __decode_ref(buf, key_refs[i], collection_offset_size, offset_table, object_cache)
+        if wanted_keys is not None and key not in wanted_keys:
+            continue
+        val = __decode_ref(buf, value_refs[i], collection_offset_size, offset_table, object_cache)
+        dict_result[key] = val
+    return dict_result
+
+
+def __decode_iterative(buf, obj_ref, collection_offset_size, offset_table, object_cache, wanted_keys=None):
+    # Produces the same result as __decode_ref, but containers are filled from an
+    # explicit work stack instead of by recursion, so deeply nested property lists
+    # don't cost a Python frame per level or run into the recursion limit.
+    # Containers are created empty, registered in the object cache and filled in
+    # place when popped off the stack, so shared references still get one instance.
+    stack = []
+
+    def resolve(ref):
+        obj = object_cache[ref]
+        if obj is __not_decoded:
+            offset = offset_table[ref]
+            type_byte = __read_type_byte(buf, offset)
+            if type_byte & 0xF0 == 0xD0:
+                obj = {}
+                stack.append((offset, type_byte, obj, None))
+            elif type_byte & 0xF0 in (0xA0, 0xC0):
+                obj = []
+                stack.append((offset, type_byte, obj, None))
             else:
-                int_type_byte = f.read(1)[0]
-            #print("Dictionary length int byte: {0}".format(hex(int_type_byte)))
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Dict field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            dict_count = __decode_multibyte_int(int_bytes, signed=False)
-        key_refs = []
-        #print("Dictionary count: {0}".format(dict_count))
-        for i in range(dict_count):
-            key_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        value_refs = []
-        for i in range(dict_count):
-            value_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        
-        dict_result = {}
-        for i in range(dict_count):
-            #print("Key ref: {0}\tVal ref: {1}".format(key_refs[i], value_refs[i]))
-            key = __decode_object(f, offset_table[key_refs[i]], collection_offset_size, offset_table)
-            val = __decode_object(f, offset_table[value_refs[i]], collection_offset_size, offset_table)
-            dict_result[key] = val
-        return dict_result
+                obj = __decode_object(buf, offset, collection_offset_size, offset_table, object_cache, type_byte)
+            object_cache[ref] = obj
+        return obj
+
+    if wanted_keys is None:
+        result = resolve(obj_ref)
+    else:
+        # A projected dict is not the complete object, so it is never cached
+        offset = offset_table[obj_ref]
+        type_byte = __read_type_byte(buf, offset)
+        if type_byte & 0xF0 != 0xD0:
+            return resolve(obj_ref)
+        result = {}
+        stack.append((offset, type_byte, result, wanted_keys))
+
+    while stack:
+        offset, type_byte, container, wanted = stack.pop()
+        if type_byte & 0xF0 == 0xD0: # Dict  1011 nnnn
+            dict_count, refs_offset = __decode_length(buf, offset, type_byte, "Dict")
+            key_refs = __decode_refs(buf, refs_offset, dict_count, collection_offset_size)
+            value_refs = __decode_refs(buf, refs_offset + dict_count * collection_offset_size, dict_count, collection_offset_size)
+            for i in range(dict_count):
+                key = resolve(key_refs[i])
+                if wanted is not None and key not in wanted:
+                    continue
+                container[key] = resolve(value_refs[i])
+        else: # Array 1010 nnnn / Set 1100 nnnn
+            count, refs_offset = __decode_length(buf, offset, type_byte, "Array" if type_byte & 0xF0 == 0xA0 else "Set")
+            for obj_ref in __decode_refs(buf, refs_offset, count, collection_offset_size):
+                container.append(resolve(obj_ref))
+    return result
 
 
-def load(f):
+def __read_buffer(f, use_mmap):
+    """Returns the contents of f as a single buffer. If use_mmap is True and f is
+    backed by a real file, the file is memory-mapped rather than read."""
+    if use_mmap:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError, io.UnsupportedOperation):
+            # Not a real (or is an empty) file: fall back to a single bulk read
+            pass
+    return f.read()
+
+
+def loads(data, keys=None, iterative=None):
     """
-    Reads and converts a file-like object containing a binary property list.
-    Takes a file-like object (must support reading and seeking) as an argument
-    Returns a data structure representing the data in the property list
+    Converts a buffer containing a binary property list. Takes any object supporting
+    slicing and the buffer protocol (str/bytes, bytearray, mmap) as an argument.
+    If keys (a set or other container of key names) is given and the top-level object
+    is a dictionary, only those keys are included and all other values are skipped
+    without being decoded.
+    By default the recursive decoder is used, and a property list nested too deeply
+    for it (RuntimeError) is decoded again by the decoder that fills containers from
+    an explicit stack. iterative=True selects the explicit-stack decoder and
+    iterative=False the recursive one alone; both produce identical output.
+    Returns a data structure representing the data in the property list; objects
+    referenced more than once in the property list are returned as a single
+    shared instance, so treat the result as read-only or copy it before mutating.
     """
     # Check magic number
-    if f.read(8) != b"bplist00":
+    if data[:8] != b"bplist00":
         raise BplistError("Bad file header")
 
     # Read trailer
-    f.seek(-32, os.SEEK_END)
-    trailer = f.read(32)
-    offset_int_size, collection_offset_size, object_count, top_level_object_index, offest_table_offset = struct.unpack(">6xbbQQQ", trailer)
+    if len(data) < 40:
+        raise BplistError("File too short to contain a trailer")
+    offset_int_size, collection_offset_size, object_count, top_level_object_index, offest_table_offset = struct.unpack_from(">6xbbQQQ", data, len(data) - 32)
 
     # Read offset table
-    f.seek(offest_table_offset)
-    offset_table = []
-    for i in range(object_count):
-        offset_table.append(__decode_multibyte_int(f.read(offset_int_size), False))
-    
-    return __decode_object(f, offset_table[top_level_object_index], collection_offset_size, offset_table)
+    offset_table = __decode_refs(data, offest_table_offset, object_count, offset_int_size)
+
+    object_cache = [__not_decoded] * object_count
+    if iterative:
+        return __decode_iterative(data, top_level_object_index, collection_offset_size, offset_table, object_cache, keys)
+    try:
+        if keys is not None:
+            top_level_offset = offset_table[top_level_object_index]
+            type_byte = __read_type_byte(data, top_level_offset)
+            if type_byte & 0xF0 == 0xD0:
+                return __decode_dict(data, top_level_offset, type_byte, collection_offset_size, offset_table, object_cache, keys)
+        return __decode_ref(data, top_level_object_index, collection_offset_size, offset_table, object_cache)
+    except RuntimeError: # maximum recursion depth exceeded
+        if iterative is not None:
+            raise
+    # Partly decoded containers may be cached, so start from a fresh cache
+    object_cache = [__not_decoded] * object_count
+    return __decode_iterative(data, top_level_object_index, collection_offset_size, offset_table, object_cache, keys)
+
+
+def load(f, use_mmap=False, keys=None, iterative=None):
+    """
+    Reads and converts a file-like object containing a binary property list.
+    Takes a file-like object (must support reading) as an argument. The whole file
+    is read in one go (or memory-mapped if use_mmap is True) and decoded from memory.
+    keys optionally restricts a top-level dictionary to those keys and iterative
+    selects the decoder (see loads()).
+    Returns a data structure representing the data in the property list
+    """
+    data = __read_buffer(f, use_mmap)
+    try:
+        return loads(data, keys, iterative)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
 
 
 def NSKeyedArchiver_common_objects_convertor(o):
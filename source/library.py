@@ -0,0 +1,800 @@
+#!/usr/bin/python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import os
+import os.path
+import time
+import bisect
+import mmap
+import struct
+import tempfile
+import binascii
+import plistlib
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import ccl_bplist
+from workflow import search_key, fold_to_ascii
+
+HOME = os.path.expanduser("~")
+BIB_DIR = HOME + "/Library/Caches/Metadata/edu.ucsd.cs.mmccrack.bibdesk/"
+
+# Record keys read by `stringify` for each search scope
+SCOPE_KEYS = {
+    'general': frozenset(['kMDItemTitle',
+                          'net_sourceforge_bibdesk_container',
+                          'kMDItemAuthors',
+                          'net_sourceforge_bibdesk_publicationdate']),
+    'titles': frozenset(['kMDItemTitle',
+                         'net_sourceforge_bibdesk_container',
+                         'net_sourceforge_bibdesk_publicationdate']),
+    'creators': frozenset(['kMDItemAuthors',
+                           'net_sourceforge_bibdesk_publicationdate'])
+}
+# Record keys read by `prepare_feedback`
+FEEDBACK_KEYS = frozenset(['net_sourceforge_bibdesk_citekey',
+                           'net_sourceforge_bibdesk_pubtype',
+                           'net_sourceforge_bibdesk_publicationdate',
+                           'kMDItemAuthors',
+                           'kMDItemEditors',
+                           'kMDItemTitle',
+                           'kMDItemDisplayName',
+                           'kMDItemWhereFroms'])
+# Record keys kept in the library snapshot
+RECORD_KEYS = (FEEDBACK_KEYS | SCOPE_KEYS['general'] |
+               frozenset(['kMDItemKeywords',
+                          'net_sourceforge_bibdesk_owningfilepath']))
+
+CITEKEY = 'net_sourceforge_bibdesk_citekey'
+KEYWORDS = 'kMDItemKeywords'
+OWNING_PATH = 'net_sourceforge_bibdesk_owningfilepath'
+PUBDATE = 'net_sourceforge_bibdesk_publicationdate'
+
+# Names of the snapshot and citekey index files in the workflow's cache
+# dir. Bump `SNAPSHOT_VERSION` whenever their contents change shape.
+SNAPSHOT_FILE = 'library.snapshot'
+CITEKEY_FILE = 'citekeys.index'
+BIBS_FILE = 'bibs.index'
+GROUPS_FILE = 'groups.index'
+BIBGROUPS_FILE = 'bibgroups.cache'
+SNAPSHOT_VERSION = 11
+
+# Kinds of BibDesk groups stored in `.bib` files
+GROUP_KINDS = ('Static', 'Smart')
+# BibDesk writes its group blocks at the very end of the `.bib` file, so
+# look for them in this many trailing bytes before scanning the whole file
+GROUPS_WINDOW = 256 * 1024
+
+# Decode at least this many changed cache files in a process pool rather
+# than serially (a cold snapshot, or BibDesk rewriting its whole cache)
+PARALLEL_MIN_FILES = 1000
+# Workflow setting with the number of processes to decode them in
+# (default: one per CPU; 1 decodes serially)
+WORKERS_SETTING = 'decode_workers'
+
+################################################
+# Read BibDesk `bplist` files
+################################################
+
+def read_cachefile(_bib, keys=None, bib_dir=BIB_DIR):
+    """Read BibDesk cache file into Python dict.
+    If `keys` is given, only those record keys are decoded."""
+    bib_path = os.path.join(bib_dir, _bib)
+    with open(bib_path, 'rb') as _file:
+        bib_data = ccl_bplist.load(_file, keys=keys)
+        _file.close()
+    return bib_data
+
+# Raised by `read_cachefile` for missing, truncated or corrupt files
+READ_ERRORS = (ccl_bplist.BplistError, struct.error, EnvironmentError,
+               ValueError, IndexError)
+
+def scan_cachedir(bib_dir=BIB_DIR):
+    """Return `dict` of cache file name -> (size, mtime)"""
+    stats = {}
+    for bib in os.listdir(bib_dir):
+        try:
+            _stat = os.stat(os.path.join(bib_dir, bib))
+        except OSError:     # deleted since `listdir`
+            continue
+        stats[bib] = (_stat.st_size, _stat.st_mtime)
+    return stats
+
+def _decode_files(args):
+    """Decode `RECORD_KEYS` of cache files. `args` is (bib_dir, names).
+    Return list of (name, record, error); `record` is `None` on error.
+    Module-level so that it can be sent to pool workers"""
+    bib_dir, names = args
+    decoded = []
+    for name in names:
+        try:
+            record = read_cachefile(name, RECORD_KEYS, bib_dir=bib_dir)
+            decoded.append((name, record, None))
+        except READ_ERRORS as err:
+            decoded.append((name, None, err))
+    return decoded
+
+################################################
+# Convert `dict` to string
+################################################
+
+def _get_datum(_dict, key):
+    """Get value from key"""
+    try:
+        if _dict[key] != []:
+            if key == 'kMDItemAuthors':
+                names = [x.split(', ') for x in _dict[key]]
+                _res = [n[0] for n in names]
+            elif key == 'net_sourceforge_bibdesk_publicationdate':
+                year = str(_dict[key]).split('-')[0]
+                _res = [year]
+            else:
+                if isinstance(_dict[key], str):
+                    _res = [_dict[key]]
+                elif isinstance(_dict[key], unicode):
+                    _res = [_dict[key]]
+                elif isinstance(_dict[key], list):
+                    _res = _dict[key]
+        else:
+            _res = []
+    except KeyError:
+        _res = []
+    return _res
+
+def stringify(_dict, scope='general'):
+    """Convert `dict` to string, depending on `scope`"""
+    _list = []
+    if scope == 'general':
+        _list += _get_datum(_dict, 'kMDItemTitle')
+        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_container')
+        _list += _get_datum(_dict, 'kMDItemAuthors')
+        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
+    elif scope == 'titles':
+        _list += _get_datum(_dict, 'kMDItemTitle')
+        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_container')
+        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
+    elif scope == 'creators':
+        _list += _get_datum(_dict, 'kMDItemAuthors')
+        _list += _get_datum(_dict, 'net_sourceforge_bibdesk_publicationdate')
+    _list = [unicode(x) for x in _list]
+    _str = ' '.join(_list)
+    return _str 
+
+def record_keys(record):
+    """Return `dict` of scope -> precomputed search key of `record`"""
+    return dict((scope, search_key(stringify(record, scope)))
+                for scope in SCOPE_KEYS)
+
+################################################
+# Field indexes
+################################################
+
+# Fields of fielded queries (``author:smith``), see `Library.field_ids`
+QUERY_FIELDS = ('author', 'year', 'type', 'kw', 'container')
+# Record keys of the text fields in ``library.fields``; author terms are
+# last names
+FIELD_KEYS = {
+    'author': 'kMDItemAuthors',
+    'type': 'net_sourceforge_bibdesk_pubtype',
+    'container': 'net_sourceforge_bibdesk_container',
+}
+
+def fold_lower(text):
+    """Return `text` folded to lowercase ASCII, as field terms are"""
+    return fold_to_ascii(unicode(text)).lower()
+
+def record_fields(record):
+    """Return `dict` of field -> list of index terms of `record`. Keywords
+    are not included, as ``library.keywords`` indexes them"""
+    fields = dict((field, [fold_lower(x) for x in _get_datum(record, key)])
+                  for field, key in FIELD_KEYS.items())
+    fields['year'] = [int(y) for y in _get_datum(record, PUBDATE)
+                      if y.isdigit()]
+    return fields
+
+def _year_range(value):
+    """Parse ``1990``, ``1990..2005``, ``1990..`` or ``..2005`` into
+    inclusive (start, end); `None` if `value` is not a year or range"""
+    start, sep, end = value.partition('..')
+    if not sep:
+        end = start
+    try:
+        return (int(start) if start else None, int(end) if end else None)
+    except ValueError:
+        return None
+
+def _post(index, terms, name):
+    """Add cache file `name` to the postings of `terms` in `index`"""
+    for term in terms:
+        index.setdefault(term, set()).add(name)
+
+def _unpost(index, terms, name):
+    """Remove cache file `name` from the postings of `terms` in `index`"""
+    for term in terms:
+        names = index.get(term)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[term]
+
+################################################
+# Read BibDesk groups from `.bib` files
+################################################
+
+def _find_group_block(buf, kind):
+    """Return contents of the `kind` group block in `buf` or `None`.
+    Searches backwards from the end, in the last `GROUPS_WINDOW` bytes
+    first and then in all of `buf`"""
+    marker = ("@comment{BibDesk %s Groups{" % kind).encode('ascii')
+    window_start = max(0, len(buf) - GROUPS_WINDOW)
+    start = buf.rfind(marker, window_start)
+    if start < 0 and window_start > 0:
+        start = buf.rfind(marker)
+    if start < 0:
+        return None
+    start += len(marker)
+    end = buf.find(b"}}", start)
+    if end < 0:
+        return None
+    return buf[start:end]
+
+def read_groups(bib_path):
+    """Return `dict` of group kind -> list of group dicts in `.bib` file.
+    The file is memory-mapped, so usually only its tail is read"""
+    groups = dict((kind, []) for kind in GROUP_KINDS)
+    with open(bib_path, 'rb') as _file:
+        if os.fstat(_file.fileno()).st_size == 0:
+            return groups
+        buf = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for kind in GROUP_KINDS:
+                plist = _find_group_block(buf, kind)
+                if plist is not None:
+                    groups[kind] = plistlib.readPlistFromString(plist.strip())
+        finally:
+            buf.close()
+    return groups
+
+################################################
+# Record id sets
+################################################
+
+def bitset(ids):
+    """Return `int` with the bits of record `ids` set"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for _id in ids:
+        buf[_id >> 3] |= 1 << (_id & 7)
+    buf.reverse()
+    return int(binascii.hexlify(bytes(buf)), 16)
+
+def bitset_ids(bits):
+    """Return sorted list of record ids set in `bits`"""
+    digits = bin(bits)[:1:-1]   # lowest bit first, without '0b'
+    return [i for i, digit in enumerate(digits) if digit == '1']
+
+################################################
+# Smart groups
+################################################
+
+# BibDesk field names used in Smart group conditions -> record keys
+SMART_FIELDS = {
+    'Title': 'kMDItemTitle',
+    'Author': 'kMDItemAuthors',
+    'Editor': 'kMDItemEditors',
+    'Keywords': KEYWORDS,
+    'Cite Key': CITEKEY,
+    'BibTeX Type': 'net_sourceforge_bibdesk_pubtype',
+    'Journal': 'net_sourceforge_bibdesk_container',
+    'Booktitle': 'net_sourceforge_bibdesk_container',
+    'Year': PUBDATE,
+}
+
+def _smaller(value, other):
+    """Numeric comparison if both are numbers, else by string"""
+    if not value:
+        return False
+    try:
+        return float(value) < float(other)
+    except ValueError:
+        return value < other
+
+def _larger(value, other):
+    """Numeric comparison if both are numbers, else by string"""
+    if not value:
+        return False
+    try:
+        return float(value) > float(other)
+    except ValueError:
+        return value > other
+
+# BibDesk's string comparisons, by condition `comparison` number
+SMART_COMPARISONS = {
+    0: lambda value, other: other in value,         # contain
+    1: lambda value, other: other not in value,     # not contain
+    2: lambda value, other: value == other,         # equal
+    3: lambda value, other: value != other,         # not equal
+    4: lambda value, other: value.startswith(other),
+    5: lambda value, other: value.endswith(other),
+    6: _smaller,
+    7: _larger,
+}
+
+def _smart_value(record, field):
+    """Return lowercased string value of BibDesk `field` in `record`.
+    Missing fields are empty, as in BibDesk"""
+    value = record.get(SMART_FIELDS.get(field))
+    if value is None:
+        return ''
+    if field == 'Year':
+        return unicode(value).split('-')[0]
+    if isinstance(value, list):
+        sep = ', ' if field == 'Keywords' else ' and '
+        value = sep.join(value)
+    return unicode(value).lower()
+
+def _compile_condition(condition):
+    """Return predicate over records for a Smart group `condition`, or
+    `None` if it cannot be evaluated locally"""
+    field = condition.get('key')
+    compare = SMART_COMPARISONS.get(condition.get('comparison'))
+    if field not in SMART_FIELDS or compare is None:
+        return None
+    other = unicode(condition.get('value', '')).lower()
+    return lambda record: compare(_smart_value(record, field), other)
+
+def compile_smart_group(group):
+    """Return predicate over records for Smart `group` dict, or `None` if
+    one of its conditions uses a field or comparison not supported here.
+    Conjunction 0 requires all conditions to match, 1 any of them"""
+    tests = [_compile_condition(c) for c in group.get('conditions', [])]
+    if None in tests:
+        return None
+    if group.get('conjunction', 0) == 1:
+        return lambda record: any(test(record) for test in tests)
+    return lambda record: all(test(record) for test in tests)
+
+################################################
+# Persistent library snapshot
+################################################
+
+class Library(object):
+    """BibDesk library, persisted between runs in the workflow's cache dir.
+
+    The snapshot holds the `RECORD_KEYS` of every cache file, keyed by file
+    name and tagged with the file's (size, mtime), along with the record's
+    search key for each scope (see :meth:`search_keys`). :meth:`refresh` only
+    stats the cache dir and re-decodes files that were added or changed
+    since the snapshot was written, so a steady-state run costs a stat
+    sweep rather than a full parse. The (size, mtime) of files that cannot
+    be decoded is kept too, so they are not retried until they change.
+
+    Records are numbered by the sorted order of their file names: the
+    record id of ``library.names[i]`` is ``i``. ``library.citekeys`` maps
+    citekeys to the set of cache files with that citekey (the same entry
+    may be in several open `.bib` files); it is also written to a small file of
+    its own so that :func:`find_record` can look items up without loading
+    the snapshot. ``library.keywords`` maps each distinct keyword to the
+    set of cache files tagged with it, and ``library.bibs`` maps each
+    owning `.bib` file to the number of records it holds; it is also
+    written to a file of its own for :func:`load_bibs`.
+    ``library.fields`` holds the postings of fielded queries: author last
+    names, years, publication types and containers (see
+    :meth:`field_ids`).
+
+    These indexes are maintained incrementally and refer to cache file
+    names, which are stable across refreshes; record ids are derived from
+    them on demand.
+
+    Static group memberships are bitsets over record ids (see
+    :meth:`group_bits`), so they can be intersected with each other or
+    with :meth:`keyword_bits`. As record ids change with the library, they
+    are persisted per ``library.stamp``.
+
+    When at least `PARALLEL_MIN_FILES` files need decoding, they are
+    sharded across `workers` processes (default: one per CPU; 1 disables
+    the pool). :func:`load_library` reads `workers` from the workflow's
+    `WORKERS_SETTING` setting.
+    """
+
+    def __init__(self, wf, bib_dir=BIB_DIR, workers=None):
+        self.wf = wf
+        self.bib_dir = bib_dir
+        self.workers = workers
+        self.created = None
+        self.generation = 0
+        self.names = []
+        self.records = []
+        self.citekeys = {}
+        self.keywords = {}
+        self.bibs = {}
+        self.fields = dict((field, {}) for field in QUERY_FIELDS
+                           if field != 'kw')
+        self._files = {}
+        self._failed = {}
+        self._search_keys = {}
+        self._path = wf.cachefile(SNAPSHOT_FILE)
+
+    def refresh(self):
+        """Bring the snapshot up to date with the cache dir. Returns `self`"""
+        self._load()
+        if self.created is None:
+            self.created = time.time()
+        stats = scan_cachedir(self.bib_dir)
+        changed = False
+        for name in set(self._files) - set(stats):
+            self._remove(name)
+            changed = True
+        # Unreadable files are only retried once their stat changes
+        failed = dict((name, stat) for name, stat in self._failed.items()
+                      if stats.get(name) == stat)
+        stale = [name for name, stat in stats.items()
+                 if self._files.get(name, (None, None))[:2] != stat and
+                 failed.get(name) != stat]
+        for name, record in self._decode(stale):
+            if name in self._files:
+                self._remove(name)
+                changed = True
+            if record is None:
+                failed[name] = stats[name]
+            else:
+                self._add(name, stats[name] + (record, record_keys(record)))
+                changed = True
+        if changed:
+            self.wf.logger.debug('library: %d changed, %d total',
+                                 len(stale), len(self._files))
+            self.generation += 1
+            self._failed = failed
+            self._save()
+        elif (failed != self._failed or
+              not os.path.exists(self.wf.cachefile(CITEKEY_FILE)) or
+              not os.path.exists(self.wf.cachefile(BIBS_FILE))):
+            self._failed = failed
+            self._save()
+        self.names = sorted(self._files)
+        self.records = [self._files[name][2] for name in self.names]
+        self._search_keys = {}
+        return self
+
+    def search_keys(self, scope):
+        """Return list of search keys for `scope` (see
+        :func:`workflow.search_key`), in record id order"""
+        keys = self._search_keys.get(scope)
+        if keys is None:
+            keys = [self._files[name][3][scope] for name in self.names]
+            self._search_keys[scope] = keys
+        return keys
+
+    @property
+    def stamp(self):
+        """Identifies this snapshot's record ids: changes whenever they may"""
+        return (self.created, self.generation)
+
+    def find(self, citekey):
+        """Return a record id for `citekey` or `None`. Records of the same
+        entry in several `.bib` files share its citekey; this returns just
+        one of them, so use ``library.citekeys`` to get them all"""
+        names = self.citekeys.get(citekey)
+        if not names:
+            return None
+        return bisect.bisect_left(self.names, min(names))
+
+    def ids(self, names):
+        """Return sorted list of record ids for cache file `names`"""
+        return sorted(bisect.bisect_left(self.names, name) for name in names)
+
+    def keyword_counts(self):
+        """Return `dict` of keyword -> number of records tagged with it"""
+        return dict((keyword, len(names))
+                    for keyword, names in self.keywords.items())
+
+    def keyword_ids(self, keyword):
+        """Return sorted posting list of record ids tagged `keyword`"""
+        return self.ids(self.keywords.get(keyword, ()))
+
+    def keyword_bits(self, keyword):
+        """Return bitset of record ids tagged `keyword`"""
+        return bitset(self.keyword_ids(keyword))
+
+    def field_ids(self, field, value):
+        """Return sorted list of ids of records whose `field` (one of
+        `QUERY_FIELDS`) matches `value`, or `None` if `value` is not valid
+        for `field`.
+
+        Authors (last names) and keywords match by prefix, containers by
+        substring and types exactly, all ignoring case and diacritics.
+        Years match a year or an inclusive range: ``1990..2005``,
+        ``1990..`` or ``..2005``"""
+        value = fold_lower(value)
+        if field == 'year':
+            bounds = _year_range(value)
+            if bounds is None:
+                return None
+            index = self.fields['year']
+            years = sorted(index)
+            lo = 0 if bounds[0] is None else bisect.bisect_left(years,
+                                                                bounds[0])
+            hi = (len(years) if bounds[1] is None else
+                  bisect.bisect_right(years, bounds[1]))
+            terms = years[lo:hi]
+        elif field == 'kw':
+            index = self.keywords
+            terms = [k for k in index if fold_lower(k).startswith(value)]
+        elif field == 'author':
+            index = self.fields['author']
+            terms = sorted(index)
+            lo = bisect.bisect_left(terms, value)
+            hi = lo
+            while hi < len(terms) and terms[hi].startswith(value):
+                hi += 1
+            terms = terms[lo:hi]
+        elif field == 'container':
+            index = self.fields['container']
+            terms = [term for term in index if value in term]
+        elif field == 'type':
+            index = self.fields['type']
+            terms = [value] if value in index else []
+        else:
+            raise ValueError('Unknown field: {0}'.format(field))
+        names = set()
+        for term in terms:
+            names |= index[term]
+        return self.ids(names)
+
+    def group_bits(self, groups):
+        """Return `dict` of group name -> bitset of member record ids for
+        Static and Smart group dicts `groups` (as read from the `.bib`
+        files). Of groups with the same name, the last one wins.
+
+        Static groups list their members' citekeys; Smart groups are
+        evaluated against the library (see :func:`compile_smart_group`).
+        Memberships are cached on disk for the current `stamp` and only
+        recomputed for groups whose definitions have changed"""
+        path = self.wf.cachefile(GROUPS_FILE)
+        index = _undump(path)
+        cached = {}
+        if index is not None and index.get('stamp') == self.stamp:
+            cached = index['groups']
+        entries = {}
+        groups = dict((group['group name'], group) for group in groups)
+        for name, group in groups.items():
+            if 'keys' in group:
+                definition = group['keys']
+            else:
+                definition = (group.get('conditions', []),
+                              group.get('conjunction', 0))
+            entry = cached.get(name)
+            if entry is None or entry[0] != definition:
+                entry = (definition, self._group_bits(group))
+            entries[name] = entry
+        if entries != cached:
+            _dump({'version': SNAPSHOT_VERSION,
+                   'stamp': self.stamp,
+                   'groups': entries}, path)
+        return dict((name, entry[1]) for name, entry in entries.items())
+
+    def _group_bits(self, group):
+        """Return bitset of member record ids of Static or Smart `group`"""
+        if 'keys' in group:
+            # every record of each citekey, as an entry may be in several
+            # open `.bib` files
+            names = set()
+            for key in group['keys'].split(','):
+                names |= self.citekeys.get(key, set())
+            return bitset(self.ids(names))
+        test = compile_smart_group(group)
+        if test is None:
+            self.wf.logger.warning('library: cannot evaluate Smart group %s',
+                                   group['group name'])
+            return 0
+        return bitset(i for i, record in enumerate(self.records)
+                      if test(record))
+
+    def _add(self, name, entry):
+        """Add snapshot `entry` (size, mtime, record) for cache file `name`
+        and index it"""
+        self._files[name] = entry
+        citekey = entry[2].get(CITEKEY)
+        if citekey is not None:
+            _post(self.citekeys, [citekey], name)
+        _post(self.keywords, entry[2].get(KEYWORDS) or (), name)
+        for field, terms in record_fields(entry[2]).items():
+            _post(self.fields[field], terms, name)
+        bib = entry[2].get(OWNING_PATH)
+        if bib is not None:
+            self.bibs[bib] = self.bibs.get(bib, 0) + 1
+
+    def _remove(self, name):
+        """Drop cache file `name` from snapshot and indexes"""
+        entry = self._files.pop(name, None)
+        if entry is None:
+            return
+        _unpost(self.citekeys, [entry[2].get(CITEKEY)], name)
+        _unpost(self.keywords, entry[2].get(KEYWORDS) or (), name)
+        for field, terms in record_fields(entry[2]).items():
+            _unpost(self.fields[field], terms, name)
+        bib = entry[2].get(OWNING_PATH)
+        if bib in self.bibs:
+            self.bibs[bib] -= 1
+            if not self.bibs[bib]:
+                del self.bibs[bib]
+
+    def _decode(self, names):
+        """Return list of (name, record) for cache files `names`,
+        in sorted order of `names`"""
+        names = sorted(names)
+        workers = self.workers or multiprocessing.cpu_count()
+        decoded = None
+        if workers > 1 and len(names) >= PARALLEL_MIN_FILES:
+            decoded = self._decode_parallel(names, workers)
+        if decoded is None:
+            decoded = _decode_files((self.bib_dir, names))
+        result = []
+        for name, record, error in decoded:
+            if error is not None:
+                self.wf.logger.warning('library: cannot read %s: %s',
+                                       name, error)
+            result.append((name, record))
+        return result
+
+    def _decode_parallel(self, names, workers):
+        """Decode `names` in a pool of `workers` processes. Contiguous
+        shards are merged back in order, so the result is the same as a
+        serial decode. Return `None` if no pool can be started"""
+        # A few shards per worker evens out uneven file sizes
+        size = max(1, len(names) // (workers * 4) + 1)
+        shards = [(self.bib_dir, names[i:i + size])
+                  for i in range(0, len(names), size)]
+        try:
+            pool = multiprocessing.Pool(workers)
+        except (OSError, ImportError, NotImplementedError) as err:
+            self.wf.logger.warning('library: no process pool: %s', err)
+            return None
+        try:
+            results = pool.map(_decode_files, shards)
+        finally:
+            pool.terminate()
+        self.wf.logger.debug('library: decoded %d files with %d workers',
+                             len(names), workers)
+        return [item for shard in results for item in shard]
+
+    def _load(self):
+        """Load snapshot from disk, if there is a usable one"""
+        try:
+            with open(self._path, 'rb') as _file:
+                snapshot = pickle.load(_file)
+        except Exception:   # missing or unreadable: rebuild from scratch
+            return
+        if (snapshot.get('version') != SNAPSHOT_VERSION or
+                snapshot.get('bib_dir') != self.bib_dir):
+            return
+        self.created = snapshot['created']
+        self.generation = snapshot['generation']
+        self._files = snapshot['files']
+        self._failed = snapshot['failed']
+        self.citekeys = snapshot['citekeys']
+        self.keywords = snapshot['keywords']
+        self.fields = snapshot['fields']
+        self.bibs = snapshot['bibs']
+
+    def _save(self):
+        """Atomically write snapshot to disk"""
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'bib_dir': self.bib_dir,
+                    'created': self.created,
+                    'generation': self.generation,
+                    'files': self._files,
+                    'failed': self._failed,
+                    'citekeys': self.citekeys,
+                    'keywords': self.keywords,
+                    'fields': self.fields,
+                    'bibs': self.bibs}
+        _dump(snapshot, self._path)
+        _dump({'version': SNAPSHOT_VERSION,
+               'bib_dir': self.bib_dir,
+               'citekeys': self.citekeys},
+              self.wf.cachefile(CITEKEY_FILE))
+        _dump({'version': SNAPSHOT_VERSION,
+               'bib_dir': self.bib_dir,
+               'bibs': self.bibs},
+              self.wf.cachefile(BIBS_FILE))
+
+def _dump(data, path):
+    """Atomically pickle `data` to `path`. Each writer has a temp file of
+    its own, so concurrent writers cannot clobber each other's data"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as _file:
+            pickle.dump(data, _file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def _undump(path):
+    """Return data pickled at `path` by :func:`_dump` if it is of the
+    current `SNAPSHOT_VERSION`, else `None`"""
+    try:
+        with open(path, 'rb') as _file:
+            data = pickle.load(_file)
+    except Exception:   # missing or unreadable
+        return None
+    if data.get('version') != SNAPSHOT_VERSION:
+        return None
+    return data
+
+def load_library(wf):
+    """Return up-to-date :class:`Library`, decoding with the number of
+    processes in the `WORKERS_SETTING` setting"""
+    return Library(wf, workers=wf.settings.get(WORKERS_SETTING)).refresh()
+
+def _load_citekeys(wf):
+    """Return persisted citekey -> set of cache file names index, or
+    `{}`"""
+    index = _undump(wf.cachefile(CITEKEY_FILE))
+    if index is None or index.get('bib_dir') != BIB_DIR:
+        return {}
+    return index['citekeys']
+
+def load_bibs(wf):
+    """Return persisted owning `.bib` file -> number of records manifest
+    as of the last refresh, or `None`. Unlike :func:`load_library`, this
+    does not load any record data"""
+    index = _undump(wf.cachefile(BIBS_FILE))
+    if index is None or index.get('bib_dir') != BIB_DIR:
+        return None
+    return index['bibs']
+
+def load_groups(wf, kind, bibs):
+    """Return list of `kind` group dicts (see `GROUP_KINDS`) from `.bib`
+    files `bibs`.
+
+    Parsed groups are cached on disk per `.bib` file and only re-read
+    when the file's (size, mtime) changes"""
+    cache = _undump(wf.cachefile(BIBGROUPS_FILE))
+    cached = cache['bibs'] if cache is not None else {}
+    entries = {}
+    for bib in bibs:
+        _stat = os.stat(bib)
+        stat = (_stat.st_size, _stat.st_mtime)
+        entry = cached.get(bib)
+        if entry is None or entry[:2] != stat:
+            wf.logger.debug('library: reading groups from %s', bib)
+            entry = stat + (read_groups(bib),)
+        entries[bib] = entry
+    if entries != cached:
+        _dump({'version': SNAPSHOT_VERSION, 'bibs': entries},
+              wf.cachefile(BIBGROUPS_FILE))
+    data = []
+    for bib in bibs:
+        data += entries[bib][2][kind]
+    return data
+
+def find_record(wf, citekey, keys=RECORD_KEYS):
+    """Return record for `citekey` (with `keys`) or `None`.
+
+    Looks `citekey` up in the persisted citekey index and decodes only
+    that one cache file. Falls back to refreshing the library if the index
+    is missing or out of date."""
+    keys = frozenset(keys) | frozenset([CITEKEY])
+    for name in sorted(_load_citekeys(wf).get(citekey, ())):
+        try:
+            record = read_cachefile(name, keys)
+        except READ_ERRORS:
+            continue
+        if record.get(CITEKEY) == citekey:
+            return record
+    lib = load_library(wf)
+    for name in sorted(lib.citekeys.get(citekey, ())):
+        try:
+            return read_cachefile(name, keys, bib_dir=lib.bib_dir)
+        except READ_ERRORS:     # deleted or truncated since the refresh
+            continue
+    return None
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import sys
+import array
+import multiprocessing
+
+import workflow
+from workflow import vectorized
+from workflow.workflow import isascii
+from library import (SCOPE_KEYS, SNAPSHOT_VERSION, QUERY_FIELDS,
+                     load_library, bitset, bitset_ids, _dump, _undump)
+
+# Names of the session cache and search indexes in the workflow's cache dir
+SESSION_FILE = 'session.cache'
+TRIGRAM_FILE = 'trigrams.{0}.index'
+PACKED_FILE = 'packed.{0}.index'
+
+# Narrow searches of at least this many records with a trigram index, and
+# score them with NumPy (if installed) from this many. The indexes are
+# only kept for libraries this large, and are rebuilt in the background
+# whenever the library changes; until then, searches scan all records in
+# Python
+TRIGRAM_MIN_RECORDS = 20000
+VECTORIZED_MIN_RECORDS = 50000
+# Without NumPy, split scans of at least this many records across one
+# process per CPU
+SHARDED_MIN_RECORDS = 100000
+
+################################################
+# Fielded queries
+################################################
+
+def parse_fields(queries):
+    """Split `queries` into fielded terms and free text.
+
+    Tokens of the form ``field:value``, with `field` in `QUERY_FIELDS`
+    and a non-empty value, are fielded terms (e.g. ``author:smith`` or
+    ``year:1990..2005``). Return list of (field, value) and list of the
+    other tokens"""
+    fields = []
+    free = []
+    for query in queries:
+        field, sep, value = query.partition(':')
+        if sep and value and field.lower() in QUERY_FIELDS:
+            fields.append((field.lower(), value))
+        else:
+            free.append(query)
+    return fields, free
+
+def field_ids(fields, ids, lib):
+    """Return ids of `ids` that match all fielded terms `fields`, in the
+    order of `ids`, and list of the terms whose value was not valid for
+    their field (e.g. ``year:19xx``), which should be searched as free
+    text"""
+    invalid = []
+    matched = None
+    for field, value in fields:
+        found = lib.field_ids(field, value)
+        if found is None:
+            invalid.append('{0}:{1}'.format(field, value))
+        elif matched is None:
+            matched = set(found)
+        else:
+            matched.intersection_update(found)
+    if matched is not None:
+        ids = [_id for _id in ids if _id in matched]
+    return ids, invalid
+
+################################################
+# Keystroke session cache
+################################################
+
+def _extends(queries, previous):
+    """Return `True` if each token of `previous` is a prefix of the token
+    at the same position of `queries`"""
+    return (len(queries) >= len(previous) and
+            all(query.startswith(prev)
+                for query, prev in zip(queries, previous)))
+
+def _fold(queries, wf):
+    """Return `True` if `Workflow.filter` will fold diacritics"""
+    return (wf.settings.get('__workflows_diacritic_folding', True) and
+            isascii(''.join(queries)))
+
+################################################
+# Trigram index
+################################################
+
+def _trigrams(text):
+    """Return set of 3-character substrings of `text`"""
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+def build_trigrams(keys):
+    """Return `dict` of trigram -> `array` of ids of search `keys` whose
+    lowercase value, capitals or initials contain the trigram.
+
+    Every key that matches a query (without `MATCH_ALLCHARS`) has all of
+    its trigrams, as each rule matches the query as a substring of one of
+    those three strings"""
+    index = {}
+    for _id, key in enumerate(keys):
+        grams = _trigrams(key[1]) | _trigrams(key[2]) | _trigrams(key[4])
+        for gram in grams:
+            ids = index.get(gram)
+            if ids is None:
+                ids = index[gram] = array.array(str('I'))
+            ids.append(_id)
+    return index
+
+def save_trigrams(lib, wf):
+    """Build and save trigram indexes of all scopes of `lib`"""
+    for scope in SCOPE_KEYS:
+        index = build_trigrams(lib.search_keys(scope))
+        # Raw bytes unpickle far faster than arrays
+        index = dict((gram, ids.tostring()) for gram, ids in index.items())
+        _dump({'version': SNAPSHOT_VERSION,
+               'stamp': lib.stamp,
+               'trigrams': index},
+              wf.cachefile(TRIGRAM_FILE.format(scope)))
+    wf.logger.debug('search: indexed trigrams of %d records',
+                    len(lib.records))
+
+def trigram_candidates(queries, scope, lib, wf):
+    """Return `set` of ids of records in `scope` that may match all
+    `queries`, or `None` if the trigram index cannot narrow them down.
+
+    `queries` must be lowercase and diacritics folded, and
+    `MATCH_ALLCHARS` off. If the index is out of date, it is rebuilt in
+    the background"""
+    grams = set()
+    for query in queries:
+        grams |= _trigrams(query)
+    if not grams or len(lib.records) < TRIGRAM_MIN_RECORDS:
+        return None
+    index = _undump(wf.cachefile(TRIGRAM_FILE.format(scope)))
+    if index is None or index['stamp'] != lib.stamp:
+        _update_indexes(wf)
+        return None
+    postings = []
+    for gram in grams:
+        ids = index['trigrams'].get(gram)
+        if ids is None:
+            return set()
+        postings.append(ids)
+    postings.sort(key=len)
+    candidates = set(array.array(str('I'), postings[0]))
+    for ids in postings[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(array.array(str('I'), ids))
+    return candidates
+
+################################################
+# NumPy search keys
+################################################
+
+def save_packed(lib, wf):
+    """Build and save :class:`workflow.vectorized.PackedKeys` of all
+    scopes of `lib`"""
+    for scope in SCOPE_KEYS:
+        _dump({'version': SNAPSHOT_VERSION,
+               'stamp': lib.stamp,
+               'keys': vectorized.PackedKeys(lib.search_keys(scope))},
+              wf.cachefile(PACKED_FILE.format(scope)))
+    wf.logger.debug('search: packed search keys of %d records',
+                    len(lib.records))
+
+def packed_keys(scope, lib, wf):
+    """Return :class:`workflow.vectorized.PackedKeys` of `scope`, or `None`
+    if they should not or cannot be used. If they are out of date, they
+    are rebuilt in the background"""
+    if (not vectorized.available or
+            len(lib.records) < VECTORIZED_MIN_RECORDS):
+        return None
+    index = _undump(wf.cachefile(PACKED_FILE.format(scope)))
+    if index is None or index['stamp'] != lib.stamp:
+        _update_indexes(wf)
+        return None
+    return index['keys']
+
+def _update_indexes(wf):
+    """Rebuild search indexes in the background"""
+    from workflow.background import run_in_background
+    run_in_background('indexes', ['/usr/bin/python',
+                                  wf.workflowfile('search.py')])
+
+################################################
+# Sharded filter
+################################################
+
+# (queries, ids, keys, max_results, wf) of the current sharded filter.
+# Forked pool workers inherit it rather than have it pickled to them
+_shard_args = None
+
+def _filter_shard(bounds):
+    """Filter the (start, end) slice of `_shard_args`' ids. Module-level
+    so that it can be sent to pool workers.
+
+    Return list of (id, score) of up to `max_results` best matches and
+    `array` of positions in ids of candidates (see `Workflow.filter`)"""
+    start, end = bounds
+    queries, ids, keys, max_results, wf = _shard_args
+    ids = ids[start:end]
+    candidates = []
+    results = wf.filter(queries, ids, keys=[keys[_id] for _id in ids],
+                        include_score=True, max_results=max_results,
+                        candidates=candidates)
+    # arrays pickle much faster than lists
+    return ([(_id, score) for _id, score, rule in results],
+            array.array(str('I'), [start + i for i in candidates]))
+
+def filter_sharded(queries, ids, keys, wf, max_results=0, candidates=None,
+                   workers=None):
+    """Like `wf.filter(queries, ids, keys=...)`, but with ascending `ids`
+    split into contiguous shards that are filtered in a pool of `workers`
+    processes (default: one per CPU).
+    Each shard's best `max_results` are merged into one ranking, which is
+    the same as an unsharded filter's.
+
+    Return `None` if there is no pool to use"""
+    global _shard_args
+    workers = workers or multiprocessing.cpu_count()
+    if workers < 2:
+        return None
+    size = len(ids) // workers + 1
+    shards = [(i, min(i + size, len(ids))) for i in range(0, len(ids), size)]
+    _shard_args = (queries, ids, keys, max_results, wf)
+    try:
+        try:
+            pool = multiprocessing.Pool(workers)
+        except (OSError, ImportError, NotImplementedError) as err:
+            wf.logger.warning('search: no process pool: %s', err)
+            return None
+        try:
+            shard_results = pool.map(_filter_shard, shards)
+        finally:
+            pool.terminate()
+    finally:
+        _shard_args = None
+    # Same ranking as `Workflow.filter`; ids stand in for positions
+    ranked = []
+    for results, shard_candidates in shard_results:
+        ranked += [(100.0 / score, keys[_id][1], _id) for _id, score in results]
+        if candidates is not None:
+            candidates.extend(shard_candidates)
+    ranked.sort()
+    if max_results:
+        ranked = ranked[:max_results]
+    return [_id for rank, lower, _id in ranked]
+
+################################################
+# Filter records
+################################################
+
+def filter_ids(queries, ids, scope, lib, wf, context=None, max_results=0):
+    """Return records of `ids` that match all `queries` in `scope`, at
+    most `max_results` of them if that is non-zero.
+
+    Fielded terms of `queries` (see :func:`parse_fields`) are looked up in
+    the field indexes of `lib` first, and only the records matching all of
+    them are scored against the remaining free text.
+
+    Alfred runs the script once per keystroke, so the candidates of the
+    last query in each (`scope`, `context`) are kept in a session cache.
+    If the new query extends the last one and `ids` are the same as for
+    the last one, only those candidates are tested. `context` names the
+    set `ids` was drawn from (e.g. the group searched in), and the cache
+    is dropped whenever the library changes.
+
+    If there are many `ids` in a large library, records are scored with
+    NumPy (see :func:`packed_keys`) or else first narrowed down to those
+    that contain all trigrams of `queries` (see
+    :func:`trigram_candidates`) and, if there are still many, filtered in
+    parallel (see :func:`filter_sharded`)"""
+    fields, queries = parse_fields([query for query in queries if query])
+    if fields:
+        ids, invalid = field_ids(fields, ids, lib)
+        queries += invalid
+    queries = [query.lower() for query in queries]
+    if not queries:
+        ids = list(ids)[:max_results or None]
+        return [lib.records[_id] for _id in ids]
+    fold = _fold(queries, wf)
+    path = wf.cachefile(SESSION_FILE)
+    session = _undump(path)
+    if session is None or session.get('stamp') != lib.stamp:
+        session = {'version': SNAPSHOT_VERSION,
+                   'stamp': lib.stamp,
+                   'queries': {}}
+    # Group membership can change without the library changing
+    ids = list(ids)
+    members = bitset(ids)
+    previous = session['queries'].get((scope, context))
+    if (previous is not None and previous[0] == members and
+            previous[2] == fold and _extends(queries, previous[1])):
+        ids = bitset_ids(previous[3])
+
+    # Packed keys score every record whatever the size of `ids`, and
+    # trigram postings cover the whole library, so both only pay off for
+    # many `ids`. Packed keys are folded, so cannot be used for non-ASCII
+    # queries
+    packed = None
+    if fold and len(ids) >= VECTORIZED_MIN_RECORDS:
+        packed = packed_keys(scope, lib, wf)
+    candidates = []
+    if packed is not None:
+        results = packed.filter(queries, ids, candidates=candidates,
+                                max_results=max_results)
+    else:
+        if fold and len(ids) >= TRIGRAM_MIN_RECORDS:
+            narrowed = trigram_candidates(queries, scope, lib, wf)
+            if narrowed is not None:
+                ids = [_id for _id in ids if _id in narrowed]
+        keys = lib.search_keys(scope)
+        results = None
+        if len(ids) >= SHARDED_MIN_RECORDS:
+            results = filter_sharded(queries, ids, keys, wf, max_results,
+                                     candidates)
+        if results is None:
+            results = wf.filter(queries, ids,
+                                keys=[keys[_id] for _id in ids],
+                                candidates=candidates,
+                                max_results=max_results)
+
+    session['queries'][(scope, context)] = (
+        members, queries, fold, bitset(ids[i] for i in candidates))
+    _dump(session, path)
+    return [lib.records[_id] for _id in results]
+
+
+################################################
+# Main Function
+################################################
+
+def main(wf):
+    """Rebuild search indexes (run in the background by `filter_ids`)"""
+    lib = load_library(wf)
+    if len(lib.records) >= TRIGRAM_MIN_RECORDS:
+        save_trigrams(lib, wf)
+    if vectorized.available and len(lib.records) >= VECTORIZED_MIN_RECORDS:
+        save_packed(lib, wf)
+
+if __name__ == '__main__':
+    wf = workflow.Workflow()
+    sys.exit(wf.run(main))
@@ -120,3 +120,4 @@ from .workflow import (MATCH_ALL, MATCH_ALLCHARS, MATCH_ATOM,
                        MATCH_CAPITALS, MATCH_INITIALS,
                        MATCH_INITIALS_CONTAIN, MATCH_INITIALS_STARTSWITH,
                        MATCH_STARTSWITH, MATCH_SUBSTRING)
+from .workflow import search_key, char_mask, fold_to_ascii
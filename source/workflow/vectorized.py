@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+
+"""
+Optional `NumPy <http://www.numpy.org/>`_ backend for
+:meth:`Workflow.filter <workflow.workflow.Workflow.filter>`.
+
+:class:`PackedKeys` holds precomputed search keys (see
+:func:`~workflow.workflow.search_key`) in packed byte buffers and NumPy
+arrays and runs the matching rules over all of them at once. Results and
+ranking are the same as :meth:`Workflow.filter`'s. It only pays off for
+tens of thousands of items.
+
+If NumPy is not installed, :data:`available` is ``False`` and callers
+should use :meth:`Workflow.filter`.
+
+"""
+
+from __future__ import print_function, unicode_literals
+
+import re
+import heapq
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from .workflow import (MATCH_STARTSWITH, MATCH_CAPITALS, MATCH_ATOM,
+                       MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN,
+                       MATCH_SUBSTRING, MATCH_ALL, MATCH_ALLCHARS)
+
+#: ``True`` if NumPy can be imported
+available = numpy is not None
+
+# Separates the strings in a packed buffer. Search keys are folded to
+# ASCII text, which does not contain it
+SEPARATOR = b'\x00'
+
+# A query can only equal an atom if it is made of atom characters
+is_atom = re.compile('^[a-z0-9]+$').match
+
+
+class _Column(object):
+    """ASCII strings packed into one buffer.
+
+    :ivar buf: the strings, each followed by :data:`SEPARATOR`
+    :ivar starts: ``numpy`` array of offsets of the strings in ``buf``
+    :ivar lengths: ``numpy`` array of lengths of the strings
+
+    """
+
+    def __init__(self, strings):
+        data = [s.encode('ascii') for s in strings]
+        self.buf = SEPARATOR.join(data) + SEPARATOR
+        self.bytes = numpy.frombuffer(self.buf, dtype=numpy.uint8)
+        self.lengths = numpy.array([len(d) for d in data], dtype=numpy.int64)
+        self.starts = numpy.zeros(len(data), dtype=numpy.int64)
+        self.starts[1:] = numpy.cumsum(self.lengths + 1)[:-1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['bytes']  # a view of `buf`
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bytes = numpy.frombuffer(self.buf, dtype=numpy.uint8)
+
+    def get(self, i):
+        """Return string ``i``"""
+        start = self.starts[i]
+        return self.buf[start:start + self.lengths[i]].decode('ascii')
+
+    def find(self, text):
+        """Find first occurrence of ``text`` in each string.
+
+        :returns: ``numpy`` arrays of the indices of the strings that
+            contain ``text`` and of the offset of ``text`` in each
+
+        """
+
+        text = numpy.frombuffer(text.encode('ascii'), dtype=numpy.uint8)
+        # positions of the first character, narrowed down to those
+        # followed by the rest of ``text``
+        end = len(self.bytes) - len(text) + 1
+        positions = numpy.flatnonzero(self.bytes[:max(end, 0)] == text[0])
+        for i in range(1, len(text)):
+            positions = positions[self.bytes[positions + i] == text[i]]
+        # `text` cannot span strings, as it contains no `SEPARATOR`
+        indices = numpy.searchsorted(self.starts, positions, side='right') - 1
+        first = numpy.ones(len(indices), dtype=bool)
+        first[1:] = indices[1:] != indices[:-1]
+        indices = indices[first]
+        return indices, positions[first] - self.starts[indices]
+
+
+class PackedKeys(object):
+    """Search keys packed for vectorized matching.
+
+    Instances can be pickled, so they only need building once.
+
+    :param keys: search keys with diacritics folded, as returned by
+        :func:`~workflow.workflow.search_key`
+    :type keys: ``list``
+
+    """
+
+    def __init__(self, keys):
+        if not available:
+            raise RuntimeError('NumPy is not installed')
+        self.size = len(keys)
+        self.lower = _Column([key[1] for key in keys])
+        self.capitals = _Column([key[2] for key in keys])
+        self.initials = _Column([key[4] for key in keys])
+        # atoms as " atom1 atom2 ... ", so " query " only matches atoms
+        self.atoms = _Column([' {0} '.format(' '.join(key[3]))
+                              for key in keys])
+
+    def _hits(self, column, query):
+        """Return boolean arrays: strings of ``column`` that start with
+        ``query`` and that contain it"""
+        indices, offsets = column.find(query)
+        startswith = numpy.zeros(self.size, dtype=bool)
+        startswith[indices[offsets == 0]] = True
+        contains = numpy.zeros(self.size, dtype=bool)
+        contains[indices] = True
+        return startswith, contains
+
+    def score(self, query, match_on=MATCH_ALL ^ MATCH_ALLCHARS):
+        """Score all keys against lowercase ASCII ``query``.
+
+        :returns: ``numpy`` arrays of scores and rules, as returned for
+            each key by the rules of :meth:`Workflow.filter`. Rules are 0
+            where no rule matched.
+
+        """
+
+        if match_on & MATCH_ALLCHARS:
+            raise ValueError('MATCH_ALLCHARS is not supported')
+
+        lq = len(query)
+        score = numpy.zeros(self.size)
+        rule = numpy.zeros(self.size, dtype=numpy.int64)
+
+        def apply(match, value, flag):
+            """Set ``score`` to ``value`` and ``rule`` to ``flag`` where
+            ``match``"""
+            score[match] = value[match]
+            rule[match] = flag
+
+        lower_starts, lower_contains = self._hits(self.lower, query)
+        length = self.lower.lengths
+
+        if match_on & MATCH_STARTSWITH:
+            apply(lower_starts, 100.0 - (length // lq), MATCH_STARTSWITH)
+
+        if match_on & MATCH_CAPITALS:
+            capitals_starts = self._hits(self.capitals, query)[0]
+            apply((score == 0) & capitals_starts,
+                  100.0 - (self.capitals.lengths // lq), MATCH_CAPITALS)
+
+        if match_on & MATCH_ATOM and is_atom(query):
+            atom = self._hits(self.atoms, ' {0} '.format(query))[1]
+            apply((score == 0) & atom, 100.0 - (length // lq), MATCH_ATOM)
+
+        if match_on & (MATCH_INITIALS_STARTSWITH | MATCH_INITIALS_CONTAIN):
+            unscored = score == 0
+            initials_starts, initials_contains = self._hits(self.initials,
+                                                            query)
+            initials_length = self.initials.lengths
+            if match_on & MATCH_INITIALS_STARTSWITH:
+                apply(unscored & initials_starts,
+                      100.0 - (initials_length // lq),
+                      MATCH_INITIALS_STARTSWITH)
+                # the contain rule is only tried if startswith fails
+                initials_contains = initials_contains & ~initials_starts
+            if match_on & MATCH_INITIALS_CONTAIN:
+                apply(unscored & initials_contains,
+                      95.0 - (initials_length // lq),
+                      MATCH_INITIALS_CONTAIN)
+
+        if match_on & MATCH_SUBSTRING:
+            apply((score == 0) & lower_contains, 90.0 - (length // lq),
+                  MATCH_SUBSTRING)
+
+        return score, rule
+
+    def filter(self, query, ids, ascending=False, include_score=False,
+               min_score=0, max_results=0,
+               match_on=MATCH_ALL ^ MATCH_ALLCHARS, candidates=None):
+        """Vectorized :meth:`Workflow.filter` over the keys ``ids``.
+
+        ``query`` is a ``unicode`` query or list of tokens; it must be
+        ASCII, as the keys are folded. ``ids`` is an ascending list of
+        key indices, standing in for ``items``. Other arguments are as for
+        :meth:`Workflow.filter`, except that ``MATCH_ALLCHARS`` is not
+        supported.
+
+        :returns: list of matching ``ids`` or ``(id, score, rule)`` tuples
+
+        """
+
+        if isinstance(query, (list, tuple)):
+            queries = [q.lower() for q in query if q]
+        else:
+            queries = [query.lower()]
+        queries = [q for q in queries if q]
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if not queries:
+            results = [(int(_id), 0, None) for _id in ids]
+            if max_results:
+                results = results[:max_results]
+            if include_score:
+                return results
+            return [t[0] for t in results]
+
+        total = numpy.zeros(self.size)
+        rule = numpy.zeros(self.size, dtype=numpy.int64)
+        scored = numpy.ones(self.size, dtype=bool)
+        matched = numpy.ones(self.size, dtype=bool)
+        for query in queries:
+            token_score, token_rule = self.score(query, match_on)
+            total += token_score
+            rule |= token_rule
+            scored &= token_score > 0
+            matched &= token_rule != 0
+
+        allowed = numpy.zeros(self.size, dtype=bool)
+        allowed[ids] = True
+        if candidates is not None:
+            hits = numpy.flatnonzero(matched & allowed)
+            candidates.extend(numpy.searchsorted(ids, hits).tolist())
+
+        hits = numpy.flatnonzero(scored & allowed)
+        scores = total[hits] / len(queries)
+        if min_score:
+            keep = scores >= min_score
+            hits, scores = hits[keep], scores[keep]
+        ranks = 100.0 / scores
+        if max_results and len(hits) > max_results:
+            # only the ``max_results`` best ranks, and any ties with the
+            # last of them, need to be sorted
+            if ascending:
+                cutoff = numpy.partition(ranks, -max_results)[-max_results]
+                keep = ranks >= cutoff
+            else:
+                cutoff = numpy.partition(ranks, max_results - 1)[
+                    max_results - 1]
+                keep = ranks <= cutoff
+            hits, scores, ranks = hits[keep], scores[keep], ranks[keep]
+        rules = rule[hits].tolist()
+        positions = numpy.searchsorted(ids, hits).tolist()
+
+        results = {}
+        lower = self.lower.get
+        for _id, score, rank, _rule, i in zip(hits.tolist(), scores.tolist(),
+                                              ranks.tolist(), rules,
+                                              positions):
+            results[(rank, lower(_id), i)] = (_id, score, _rule)
+
+        if max_results and len(results) > max_results:
+            if ascending:
+                keys = heapq.nlargest(max_results, results)
+            else:
+                keys = heapq.nsmallest(max_results, results)
+        else:
+            keys = sorted(results.keys(), reverse=ascending)
+        results = [results[k] for k in keys]
+
+        if include_score:
+            return results
+        return [t[0] for t in results]
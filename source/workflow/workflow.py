@@ -23,6 +23,7 @@ import os
 import sys
 import string
 import re
+import heapq
 import plistlib
 import subprocess
 import unicodedata
@@ -32,6 +33,7 @@ import pickle
 import time
 import logging
 import logging.handlers
+from collections import OrderedDict
 try:
     import xml.etree.cElementTree as ET
 except ImportError:  # pragma: no cover
@@ -82,7 +84,7 @@ ICON_WEB = ('/System/Library/CoreServices/CoreTypes.bundle/Contents'
 
 ####################################################################
 # non-ASCII to ASCII diacritic folding.
-# Used by ``fold_to_ascii`` method
+# Used by ``fold_to_ascii`` function
 ####################################################################
 
 ASCII_REPLACEMENTS = {
@@ -373,6 +375,12 @@ ASCII_REPLACEMENTS = {
     'ỹ': 'y',
 }
 
+# ``ASCII_REPLACEMENTS`` as a table for ``unicode.translate``
+ASCII_TRANSLATION = dict((ord(c), r) for c, r in ASCII_REPLACEMENTS.items())
+
+# Number of folded strings ``fold_to_ascii`` remembers
+FOLD_CACHE_SIZE = 4096
+
 ####################################################################
 # Used by `Workflow.filter`
 ####################################################################
@@ -443,6 +451,158 @@ def isascii(text):
     return True
 
 
+def fold_to_ascii(text):
+    """Convert non-ASCII characters to closest ASCII equivalent.
+
+    See :meth:`Workflow.fold_to_ascii`. The last :const:`FOLD_CACHE_SIZE`
+    results are cached.
+
+    """
+
+    if isascii(text):
+        return text
+    try:
+        folded = _fold_cache.pop(text)
+    except KeyError:
+        folded = text.translate(ASCII_TRANSLATION)
+        if not isascii(folded):
+            folded = unicode(unicodedata.normalize('NFKD',
+                             folded).encode('ascii', 'ignore'))
+        if len(_fold_cache) >= FOLD_CACHE_SIZE:
+            _fold_cache.popitem(last=False)
+    # (re-)insert as most recently used
+    _fold_cache[text] = folded
+    return folded
+
+_fold_cache = OrderedDict()
+
+
+def search_key(value, fold_diacritics=True):
+    """Precompute the parts of ``value`` that :meth:`Workflow.filter`
+    matches against.
+
+    Pass a list of these as the ``keys`` argument of
+    :meth:`Workflow.filter` to save it rebuilding them on every call.
+
+    :param value: search key of an item
+    :type value: ``unicode``
+    :param fold_diacritics: fold ``value`` to ASCII before
+        computing its parts
+    :type fold_diacritics: ``Boolean``
+    :returns: tuple ``(value, lower, capitals, atoms, initials, mask,
+        overflow)``: ``value`` unaltered, then lowercase (folded) ``value``,
+        its lowercased capitals, its lowercase "atoms", their initials and
+        the :func:`char_mask` of lowercase ``value``
+    :rtype: ``tuple``
+
+    """
+
+    folded = value
+    if fold_diacritics:
+        folded = fold_to_ascii(value)
+    lower = folded.lower()
+    capitals = ''.join([c for c in folded if c in INITIALS])
+    atoms = tuple([s.lower() for s in split_on_delimiters(folded)])
+    initials = ''.join([s[0] for s in atoms if s])
+    return (value, lower, capitals.lower(), atoms, initials) + char_mask(lower)
+
+
+def char_mask(text):
+    """Return the characters in ``text`` as ``(mask, overflow)``.
+
+    ``mask`` has bit ``ord(c)`` set for every ASCII character ``c`` in
+    ``text``; ``overflow`` holds the other characters. Whether ``text``
+    contains all characters of another string is then mostly a matter of
+    ANDing their masks.
+
+    :param text: text to get characters of
+    :type text: ``unicode``
+    :returns: ``(mask, overflow)``
+    :rtype: ``tuple`` of ``int`` and ``unicode``
+
+    """
+
+    mask = 0
+    overflow = set()
+    for c in set(text):
+        if c < '\x80':
+            mask |= 1 << ord(c)
+        else:
+            overflow.add(c)
+    return mask, ''.join(sorted(overflow))
+
+
+def _score(query, key, match_on, search):
+    """Score ``key`` from :func:`search_key` against ``query``.
+
+    Implements the matching rules of :meth:`Workflow.filter`.
+    Returns ``(score, rule)``; ``score`` is 0 if there is no match.
+
+    """
+
+    rule = None
+    score = 0
+    lower, capitals, atoms, initials = key[1:5]
+    # all keys are ASCII or else not folded, so `lower` is as long as
+    # the value it was made from
+    length = len(lower)
+
+    # item starts with query
+    if match_on & MATCH_STARTSWITH and lower.startswith(query):
+        score = 100.0 - (length // len(query))
+        rule = MATCH_STARTSWITH
+
+    if not score and match_on & MATCH_CAPITALS:
+        # query matches capitalised letters in item,
+        # e.g. of = OmniFocus
+        if capitals.startswith(query):
+            score = 100.0 - (len(capitals) // len(query))
+            rule = MATCH_CAPITALS
+
+    if not score and match_on & MATCH_ATOM:
+        # is `query` one of the item's atoms, i.e. words separated by
+        # spaces or other non-word characters? Similar to substring, but
+        # scores more highly, as it's a word within the item
+        if query in atoms:
+            score = 100.0 - (length // len(query))
+            rule = MATCH_ATOM
+
+    if not score:
+        # `query` matches start (or all) of the initials of the
+        # atoms, e.g. ``himym`` matches "How I Met Your Mother"
+        # *and* "how i met your mother" (the ``capitals`` rule only
+        # matches the former)
+        if (match_on & MATCH_INITIALS_STARTSWITH and
+                initials.startswith(query)):
+            score = 100.0 - (len(initials) // len(query))
+            rule = MATCH_INITIALS_STARTSWITH
+
+        # `query` is a substring of initials, e.g. ``doh`` matches
+        # "The Dukes of Hazzard"
+        elif (match_on & MATCH_INITIALS_CONTAIN and
+                query in initials):
+            score = 95.0 - (len(initials) // len(query))
+            rule = MATCH_INITIALS_CONTAIN
+
+    if not score:
+        # `query` is a substring of item
+        if match_on & MATCH_SUBSTRING and query in lower:
+            score = 90.0 - (length // len(query))
+            rule = MATCH_SUBSTRING
+
+    if not score:
+        # finally, assign a score based on how close together the
+        # characters in `query` are in item.
+        if match_on & MATCH_ALLCHARS:
+            match = search(lower)
+            if match:
+                score = 100.0 / ((1 + match.start()) *
+                                 (match.end() - match.start() + 1))
+                rule = MATCH_ALLCHARS
+
+    return score, rule
+
+
 ####################################################################
 # Implementation classes
 ####################################################################
@@ -976,14 +1136,22 @@ class Workflow(object):
 
     def filter(self, query, items, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL ^ MATCH_ALLCHARS, fold_diacritics=True):
+               match_on=MATCH_ALL ^ MATCH_ALLCHARS, fold_diacritics=True,
+               keys=None, candidates=None):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
         ``query`` is case-insensitive. Any item that does not contain the
         entirety of ``query`` is rejected.
 
+        ``query`` may also be a list of tokens (e.g. the words of a
+        query). Items must then match every token; all tokens are tested
+        in one pass over ``items``. An item's score is the mean of its
+        tokens' scores and its ``rule`` the bitwise OR of their rules.
+        Empty tokens are ignored, and if there are none, all ``items`` are
+        returned unfiltered.
+
         :param query: query to test items against
-        :type query: ``unicode``
+        :type query: ``unicode`` or ``list`` of ``unicode``
         :param items: iterable of items to test
         :type items: ``list`` or ``tuple``
         :param key: function to get comparison key from ``items``. Must return a
@@ -999,6 +1167,8 @@ class Workflow(object):
             than this.
         :type min_score: ``int``
         :param max_results: If non-zero, prune results list to this length.
+            Only the best ``max_results`` matches are then ranked, which is
+            much cheaper than sorting all of them.
         :type max_results: ``int``
         :param match_on: Filter option flags. Bitwise-combined list of
             ``MATCH_*`` constants (see below).
@@ -1006,6 +1176,18 @@ class Workflow(object):
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param keys: Precomputed search keys, one :func:`search_key`
+            (with diacritics folded) per item in ``items``. If given,
+            ``key`` is not called, and items are pre-filtered on the
+            keys' character masks instead of character sets.
+        :type keys: ``list``
+        :param candidates: If a list, the indices (in ``items``) of all
+            items that satisfy a matching rule for every token are
+            appended to it, including items whose score is too low to be
+            returned. With the same ``match_on``, these are a superset of
+            the matches of any query whose tokens extend those of
+            ``query``, so a refined query only needs to test them.
+        :type candidates: ``list``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_`` rule that matched the item.
@@ -1059,103 +1241,82 @@ class Workflow(object):
         """
 
         results = {}
-        query = query.lower()
-        queryset = set(query)
+        if isinstance(query, (list, tuple)):
+            queries = [q.lower() for q in query if q]
+        else:
+            queries = [query.lower()]
+        if not queries or not queries[0]:
+            results = [(item, 0, None) for item in items]
+            if max_results:
+                results = results[:max_results]
+            if include_score:
+                return results
+            return [t[0] for t in results]
+        queryset = set(''.join(queries))
+        query_mask, query_overflow = char_mask(''.join(queries))
+        query_overflow = set(query_overflow)
 
         # Use user override if there is one
         fold_diacritics = self.settings.get('__workflows_diacritic_folding',
                                             fold_diacritics)
 
-        if not isascii(query):
+        if not isascii(''.join(queries)):
             fold_diacritics = False
 
-        # Build pattern: include all characters
-        pattern = []
-        for c in query:
-            # pattern.append('[^{0}]*{0}'.format(re.escape(c)))
-            pattern.append('.*?{0}'.format(re.escape(c)))
-        pattern = ''.join(pattern)
-        search = re.compile(pattern, re.IGNORECASE).search
+        # Build patterns: include all characters
+        searches = []
+        for query in queries:
+            pattern = []
+            for c in query:
+                # pattern.append('[^{0}]*{0}'.format(re.escape(c)))
+                pattern.append('.*?{0}'.format(re.escape(c)))
+            pattern = ''.join(pattern)
+            searches.append(re.compile(pattern, re.IGNORECASE).search)
+        tokens = list(zip(queries, searches))
         # print('filter: searching %d items' % len(items))
 
         for i, item in enumerate(items):
-            rule = None
-            score = 0
-            value = key(item)
-
-            if fold_diacritics:
-                value = self.fold_to_ascii(value)
+            if keys is not None and fold_diacritics:
+                # pre-filter any items that do not contain all characters
+                # of ``query`` with the key's precomputed character mask
+                _key = keys[i]
+                if (_key[5] & query_mask != query_mask or
+                        query_overflow and
+                        not query_overflow <= set(_key[6])):
+                    continue
+                lower = _key[1]
+            else:
+                if keys is None:
+                    value = key(item)
+                    if fold_diacritics:
+                        value = self.fold_to_ascii(value)
+                else:
+                    value = keys[i][0]
+                lower = value.lower()
+
+                # pre-filter any items that do not contain all characters
+                # of ``query`` to save on running several more expensive
+                # tests
+                if not queryset <= set(lower):
+                    continue
+
+                _key = search_key(value, fold_diacritics=False)
+            scores = []
+            rule = 0
+            for query, search in tokens:
+                token_score, token_rule = _score(query, _key, match_on,
+                                                 search)
+                if token_rule is None:
+                    break
+                scores.append(token_score)
+                rule |= token_rule
+            else:
+                if candidates is not None:
+                    candidates.append(i)
 
-            # pre-filter any items that do not contain all characters
-            # of ``query`` to save on running several more expensive tests
-            if not queryset <= set(value.lower()):
+            if len(scores) < len(tokens) or min(scores) <= 0:
                 continue
-
-            # item starts with query
-            if (match_on & MATCH_STARTSWITH and
-                    value.lower().startswith(query)):
-                score = 100.0 - (len(value) / len(query))
-                rule = MATCH_STARTSWITH
-
-            if not score and match_on & MATCH_CAPITALS:
-                # query matches capitalised letters in item,
-                # e.g. of = OmniFocus
-                initials = ''.join([c for c in value if c in INITIALS])
-                if initials.lower().startswith(query):
-                    score = 100.0 - (len(initials) / len(query))
-                    rule = MATCH_CAPITALS
-
-            if not score:
-                if (match_on & MATCH_ATOM or
-                        match_on & MATCH_INITIALS_CONTAIN or
-                        match_on & MATCH_INITIALS_STARTSWITH):
-                    # split the item into "atoms", i.e. words separated by
-                    # spaces or other non-word characters
-                    atoms = [s.lower() for s in split_on_delimiters(value)]
-                    # print('atoms : %s  -->  %s' % (value, atoms))
-                    # initials of the atoms
-                    initials = ''.join([s[0] for s in atoms if s])
-
-                if match_on & MATCH_ATOM:
-                    # is `query` or set of `query` in set of item's atoms?
-                    # similar to substring, but scores more highly, as it's
-                    # a word within the item
-                    if query in atoms:
-                        score = 100.0 - (len(value) / len(query))
-                        rule = MATCH_ATOM
-
-            if not score:
-                # `query` matches start (or all) of the initials of the
-                # atoms, e.g. ``himym`` matches "How I Met Your Mother"
-                # *and* "how i met your mother" (the ``capitals`` rule only
-                # matches the former)
-                if (match_on & MATCH_INITIALS_STARTSWITH and
-                        initials.startswith(query)):
-                    score = 100.0 - (len(initials) / len(query))
-                    rule = MATCH_INITIALS_STARTSWITH
-
-                # `query` is a substring of initials, e.g. ``doh`` matches
-                # "The Dukes of Hazzard"
-                elif (match_on & MATCH_INITIALS_CONTAIN and
-                        query in initials):
-                    score = 95.0 - (len(initials) / len(query))
-                    rule = MATCH_INITIALS_CONTAIN
-
-            if not score:
-                # `query` is a substring of item
-                if match_on & MATCH_SUBSTRING and query in value.lower():
-                    score = 90.0 - (len(value) / len(query))
-                    rule = MATCH_SUBSTRING
-
-            if not score:
-                # finally, assign a score based on how close together the
-                # characters in `query` are in item.
-                if match_on & MATCH_ALLCHARS:
-                    match = search(value)
-                    if match:
-                        score = 100.0 / ((1 + match.start()) *
-                                         (match.end() - match.start() + 1))
-                        rule = MATCH_ALLCHARS
+            score = sum(scores) / len(scores)
 
             if min_score and score < min_score:
                 continue
@@ -1164,15 +1325,18 @@ class Workflow(object):
                 # use "reversed" `score` (i.e. highest becomes lowest) and
                 # `value` as sort key. This means items with the same score
                 # will be sorted in alphabetical not reverse alphabetical order
-                results[(100.0 / score, value.lower(), i)] = (item, score,
-                                                              rule)
+                results[(100.0 / score, lower, i)] = (item, score, rule)
 
         # sort on keys, then discard the keys
-        keys = sorted(results.keys(), reverse=ascending)
-        results = [results.get(k) for k in keys]
-
         if max_results and len(results) > max_results:
-            results = results[:max_results]
+            # select top ``max_results`` with a heap: O(n log k)
+            if ascending:
+                keys = heapq.nlargest(max_results, results)
+            else:
+                keys = heapq.nsmallest(max_results, results)
+        else:
+            keys = sorted(results.keys(), reverse=ascending)
+        results = [results.get(k) for k in keys]
 
         # return list of ``(item, score, rule)``
         if include_score:
@@ -1438,11 +1602,7 @@ class Workflow(object):
         :rtype: ``unicode``
 
         """
-        if isascii(text):
-            return text
-        text = ''.join([ASCII_REPLACEMENTS.get(c, c) for c in text])
-        return unicode(unicodedata.normalize('NFKD',
-                       text).encode('ascii', 'ignore'))
+        return fold_to_ascii(text)
 
     def _load_info_plist(self):
         """Load workflow info from ``info.plist``